@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import QModelIndex, Qt
+
+import main
+from main import Playlist
+
+
+SIZES = [1000, 10000, 100000]
+BASELINE_PATH = './benchmarks/baseline.json'
+TOLERANCE = 0.25
+REMOVE_COUNT = 1000
+REPEAT = 3
+MIN_TIME_DELTA = 0.005
+BATCH_SIZE = 500
+
+
+def make_library(root, count):
+    tracks = []
+    for i in range(count):
+        directory = os.path.join(root, 'artist%03d' % (i // 1000), 'album%02d' % (i // 100 % 10))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'track%06d.mp3' % i)
+        with open(path, 'wb') as f:
+            # Sparse files with distinct sizes, so duplicate detection never has to hash them.
+            f.truncate(1024 + i)
+        tracks.append(path)
+    return tracks
+
+
+def write_playlist(path, tracks):
+    with open(path, 'w') as f:
+        f.write(json.dumps({'name': 'bench', 'tracks': tracks, 'current_track_index': 0, 'generation': 1}))
+    if os.path.exists(path + Playlist.JOURNAL_SUFFIX):
+        os.remove(path + Playlist.JOURNAL_SUFFIX)
+
+
+class Context:
+
+    def __init__(self, workdir, tracks, library):
+        self.workdir = workdir
+        self.tracks = tracks
+        self.library = library
+        self.playlist_path = os.path.join(workdir, 'bench.playlist')
+
+    def fresh_playlist(self, tracks=None):
+        write_playlist(self.playlist_path, self.tracks if tracks is None else tracks)
+        return Playlist(path=self.playlist_path)
+
+    def playlist(self, store):
+        return Playlist(path=self.playlist_path, store=store)
+
+    def media_player(self, tracks=None):
+        write_playlist(self.playlist_path, self.tracks if tracks is None else tracks)
+        persistence = main.PersistenceService(main.Settings.FLUSH_INTERVAL)
+        player = main.MediaPlayer(self.playlist_path, persistence)
+        return player, persistence
+
+
+def bench_playlist_save(context):
+    playlist = context.fresh_playlist()
+    return lambda: playlist.save()
+
+
+def bench_playlist_load(context):
+    context.fresh_playlist()
+    return lambda: Playlist(path=context.playlist_path)
+
+
+def bench_media_player_load(context):
+    player, persistence = context.media_player()
+
+    def run():
+        player.load_playlist(context.playlist_path)
+        persistence.close()
+    return run
+
+
+def bench_add_media(context):
+    player, persistence = context.media_player([])
+    player.change_playlist(Playlist(path=context.playlist_path, persistence=persistence))
+
+    def run():
+        for track in context.tracks:
+            player.add_media(track)
+        persistence.close()
+    return run
+
+
+def bench_add_media_batch(context):
+    player, persistence = context.media_player([])
+    player.change_playlist(Playlist(path=context.playlist_path, persistence=persistence))
+
+    def run():
+        for start in range(0, len(context.tracks), BATCH_SIZE):
+            player.add_media_batch(context.tracks[start:start + BATCH_SIZE])
+        persistence.close()
+    return run
+
+
+def bench_model_data(context):
+    model = main.PlaylistModel(context.fresh_playlist())
+
+    def run():
+        while model.canFetchMore(QModelIndex()):
+            model.fetchMore(QModelIndex())
+        for row in range(model.rowCount()):
+            model.data(model.index(row), Qt.DisplayRole)
+    return run
+
+
+def bench_model_row_count(context):
+    model = main.PlaylistModel(context.fresh_playlist())
+
+    def run():
+        for _ in range(len(context.tracks)):
+            model.rowCount()
+    return run
+
+
+def bench_remove_media(context):
+    player, persistence = context.media_player()
+    player.change_playlist(Playlist(path=context.playlist_path, persistence=persistence))
+
+    def run():
+        for _ in range(min(REMOVE_COUNT, len(context.tracks))):
+            player.remove_media(0)
+        persistence.close()
+    return run
+
+
+def bench_folder_scan(context):
+    scanner = main.FolderScanner(context.library, main.MediaPlayer.SUPPORTED_FORMATS)
+    found = []
+    scanner.chunk_found.connect(found.extend)
+    return scanner.run
+
+
+BENCHMARKS = [
+    ('Playlist.save', bench_playlist_save),
+    ('Playlist.load', bench_playlist_load),
+    ('MediaPlayer.load', bench_media_player_load),
+    ('add_media', bench_add_media),
+    ('add_media_batch', bench_add_media_batch),
+    ('PlaylistModel.data', bench_model_data),
+    ('PlaylistModel.rowCount', bench_model_row_count),
+    ('remove_media', bench_remove_media),
+    ('FolderScanner', bench_folder_scan),
+]
+
+
+def measure(setup, context, repeat=REPEAT):
+    seconds = None
+    for _ in range(repeat):
+        run = setup(context)
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    run = setup(context)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def measure_memory_per_track(context):
+    tracemalloc.start()
+    playlist = context.playlist(main.TrackStore())
+    model = main.PlaylistModel(playlist)
+    while model.canFetchMore(QModelIndex()):
+        model.fetchMore(QModelIndex())
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return current / max(len(context.tracks), 1)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        # Sub-millisecond timings are mostly noise, so small absolute differences never count.
+        if 'time' in result and result['time'] > base['time'] * (1 + tolerance) \
+                and result['time'] - base['time'] > MIN_TIME_DELTA:
+            regressions.append('%s time: %.4f s -> %.4f s' % (key, base['time'], result['time']))
+        for field in ('peak', 'bytes'):
+            if field in result and base.get(field) and result[field] > base[field] * (1 + tolerance):
+                regressions.append('%s %s: %d -> %d bytes' % (key, field, base[field], result[field]))
+    return regressions
+
+
+def main_bench(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark playlist, model and import hot paths.')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)))
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args(argv)
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = set(args.only.split(',')) if args.only else None
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='music-player-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for size in sizes:
+            library = os.path.join(workdir, 'library%d' % size)
+            context = Context(workdir, make_library(library, size), library)
+            for name, setup in BENCHMARKS:
+                if only and name not in only:
+                    continue
+                seconds, peak = measure(setup, context, args.repeat)
+                results['%s@%d' % (name, size)] = {'time': seconds, 'peak': peak}
+                print('%-24s %7d %10.4f s %10.2f MB' % (name, size, seconds, peak / 1024 / 1024))
+                app.processEvents()
+            if not only or 'memory' in only:
+                write_playlist(context.playlist_path, context.tracks)
+                per_track = measure_memory_per_track(context)
+                results['memory per track@%d' % size] = {'bytes': per_track}
+                print('%-24s %7d %10.0f B/track' % ('memory per track', size, per_track))
+            shutil.rmtree(library)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        directory = os.path.dirname(args.baseline)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(args.baseline, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True))
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.loads(f.read()), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_bench())
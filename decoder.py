@@ -0,0 +1,69 @@
+from PyQt5.QtCore import QEventLoop, Qt
+from PyQt5.QtMultimedia import QAudioDecoder, QAudioFormat
+
+
+class PcmDecoder:
+
+    def __init__(self, numpy, channels, sample_rate):
+        self.numpy = numpy
+        self.audio_format = QAudioFormat()
+        self.audio_format.setCodec('audio/pcm')
+        self.audio_format.setSampleType(QAudioFormat.SignedInt)
+        self.audio_format.setSampleSize(16)
+        self.audio_format.setByteOrder(QAudioFormat.LittleEndian)
+        self.audio_format.setChannelCount(channels)
+        self.audio_format.setSampleRate(sample_rate)
+        self._decoder = None
+        self._loop = None
+        self._consume = None
+        self._cancelled = None
+        self._failed = False
+
+    def decode(self, track, consume, cancelled=None):
+        self._decoder = QAudioDecoder()
+        self._decoder.setAudioFormat(self.audio_format)
+        self._decoder.setSourceFilename(track)
+        self._loop = QEventLoop()
+        self._consume = consume
+        self._cancelled = cancelled
+        self._failed = False
+        # Decoding runs in worker threads and processes, so the slots must not be queued to another thread.
+        self._decoder.bufferReady.connect(self.buffer_ready, Qt.DirectConnection)
+        self._decoder.finished.connect(self._loop.quit, Qt.DirectConnection)
+        self._decoder.error.connect(self.decode_error, Qt.DirectConnection)
+        self._decoder.start()
+        self._loop.exec()
+        self._decoder.stop()
+        self._decoder.deleteLater()
+        self._decoder = None
+        return not self._failed
+
+    def buffer_ready(self):
+        buffer = self._decoder.read()
+        samples = self.samples(buffer)
+        if samples is not None:
+            self._consume(samples, buffer.format())
+        if self._cancelled is not None and self._cancelled():
+            self._failed = True
+            self._loop.quit()
+
+    def decode_error(self, error):
+        self._failed = True
+        self._loop.quit()
+
+    def samples(self, buffer):
+        numpy = self.numpy
+        audio_format = buffer.format()
+        data = buffer.constData()
+        if data is None or not buffer.byteCount():
+            return None
+        data = data.asstring(buffer.byteCount())
+        size, kind = audio_format.sampleSize(), audio_format.sampleType()
+        if kind == QAudioFormat.Float and size == 32:
+            return numpy.frombuffer(data, dtype='<f4')
+        if kind == QAudioFormat.SignedInt and size in (8, 16, 32):
+            samples = numpy.frombuffer(data, dtype='<i%d' % (size // 8))
+            return samples.astype(numpy.float32) / float(1 << (size - 1))
+        if kind == QAudioFormat.UnSignedInt and size == 8:
+            return (numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float32) - 128) / 128
+        return None
@@ -1,20 +1,315 @@
+import time
+
+STARTUP_TIME = time.perf_counter()
+
 import os
 import sys
 import json
+import math
+import queue
+import random
+import signal
+import inspect
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+from array import array
+from functools import partial, wraps
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 
-from PyQt5.Qt import Qt
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import QAbstractListModel, QObject, QUrl, pyqtSignal
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtMultimedia import *
-from PyQt5.QtMultimediaWidgets import *
+from PyQt5.QtCore import (
+    QAbstractListModel, QCoreApplication, QEvent, QFileSystemWatcher, QItemSelectionModel, QLineF, QMimeData, QModelIndex, QObject, QThread, QTimer, QUrl, Qt, pyqtSignal
+)
+from PyQt5.QtGui import QImage, QPainter, QPixmap
+from PyQt5.QtMultimedia import QMediaContent, QMediaMetaData, QMediaPlayer
 from gui import Ui_MainWindow
+from decoder import PcmDecoder
+from workers import full_hash, load_numpy, measure_loudness, partial_hash, read_tags
+
+
+class StartupProfile:
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, stream=sys.stderr):
+        stream.write('Startup profile:\n')
+        for phase, seconds in self.phases:
+            stream.write('  %-20s %8.1f ms\n' % (phase, seconds * 1000))
+        stream.write('  %-20s %8.1f ms\n' % ('total', (self.last - self.start) * 1000))
+        peak = peak_memory()
+        if peak is not None:
+            stream.write('  %-20s %8.1f MB\n' % ('peak RSS', peak / 1024 / 1024))
+            stream.write('  %-20s %8.1f MB\n' % ('peak worker RSS', peak_memory(children=True) / 1024 / 1024))
+
+
+def peak_memory(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    # For children this is the largest worker process that has exited, live workers are not counted yet.
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Instrumentation:
+    BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+    STALL_INTERVAL = 10
+    STALL_THRESHOLD = 50
+    MAX_EVENTS = 100000
+
+    def __init__(self, stall_threshold=STALL_THRESHOLD):
+        self.start = time.perf_counter()
+        self.stall_threshold = stall_threshold
+        self.stats = {}
+        self.events = deque(maxlen=self.MAX_EVENTS)
+        self.stalls = deque(maxlen=self.MAX_EVENTS)
+        self._lock = threading.Lock()
+        self._timer = None
+        self._last_tick = None
+
+    def patch(self, cls, names):
+        for name in names:
+            setattr(cls, name, self.wrap('%s.%s' % (cls.__name__, name), getattr(cls, name)))
+
+    def wrap(self, name, function):
+        code = function.__code__
+        # Qt passes every signal argument it has; plain slots get only as many as they accept.
+        limit = None if code.co_flags & inspect.CO_VARARGS else code.co_argcount
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if limit is not None:
+                args = args[:limit]
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, start, time.perf_counter() - start)
+        return wrapper
+
+    def record(self, name, start, duration):
+        milliseconds = duration * 1000
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = [0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+            stats[0] += 1
+            stats[1] += milliseconds
+            stats[2] = max(stats[2], milliseconds)
+            stats[3][bisect_left(self.BUCKETS, milliseconds)] += 1
+            self.events.append((name, start, duration, threading.get_ident()))
+
+    def watch_event_loop(self, parent=None):
+        self._timer = QTimer(parent)
+        self._timer.setInterval(self.STALL_INTERVAL)
+        self._timer.timeout.connect(self.tick)
+        self._last_tick = time.perf_counter()
+        self._timer.start()
+
+    def tick(self):
+        now = time.perf_counter()
+        elapsed = now - self._last_tick
+        if elapsed * 1000 - self.STALL_INTERVAL > self.stall_threshold:
+            with self._lock:
+                self.stalls.append((self._last_tick, elapsed))
+        self._last_tick = now
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.events.clear()
+            self.stalls.clear()
+
+    def percentile(self, buckets, count, fraction):
+        seen = 0
+        for bound, hits in zip(self.BUCKETS + (float('inf'),), buckets):
+            seen += hits
+            if seen >= count * fraction:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        with self._lock:
+            rows = []
+            for name, (count, total, longest, buckets) in self.stats.items():
+                rows.append({
+                    'name': name,
+                    'count': count,
+                    'total': total,
+                    'mean': total / count,
+                    'p50': self.percentile(buckets, count, 0.5),
+                    'p95': self.percentile(buckets, count, 0.95),
+                    'max': longest,
+                    'histogram': dict(zip([str(bound) for bound in self.BUCKETS] + ['inf'], buckets)),
+                })
+            stalls = [{'start': (start - self.start) * 1000, 'duration': duration * 1000} for start, duration in self.stalls]
+        rows.sort(key=lambda row: row['total'], reverse=True)
+        return rows, stalls
+
+    def to_json(self):
+        rows, stalls = self.summary()
+        for row in rows:
+            for key in ('p50', 'p95'):
+                if row[key] == float('inf'):
+                    row[key] = None
+        return json.dumps({'calls': rows, 'stalls': stalls, 'stall_threshold': self.stall_threshold}, indent=2)
+
+    def to_trace(self):
+        pid = os.getpid()
+        with self._lock:
+            events = [{
+                'name': name, 'cat': 'call', 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': (start - self.start) * 1000000, 'dur': duration * 1000000,
+            } for name, start, duration, tid in self.events]
+            events.extend({
+                'name': 'event loop stall', 'cat': 'stall', 'ph': 'X', 'pid': pid, 'tid': threading.main_thread().ident,
+                'ts': (start - self.start) * 1000000, 'dur': duration * 1000000,
+            } for start, duration in self.stalls)
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+    def export(self, path, trace=False):
+        atomic_write(path, self.to_trace() if trace else self.to_json())
+
+def atomic_write(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+_pool_lock = threading.Lock()
+
+
+def worker_pool(workers):
+    # Spawned workers import the script that started them. Their tasks live in workers.py, so that module stands in
+    # for __main__ while they start, instead of this one with Qt widgets and the generated UI.
+    context = multiprocessing.get_context('spawn')
+    with _pool_lock:
+        main_module = sys.modules['__main__']
+        sys.modules['__main__'] = sys.modules['workers']
+        try:
+            return context.Pool(workers)
+        finally:
+            sys.modules['__main__'] = main_module
+
+
+def close_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def connect_library(path):
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS metadata ('
+        'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+        'title TEXT, artist TEXT, album TEXT, album_artist TEXT, duration INTEGER)'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS hashes ('
+        'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, partial TEXT, full TEXT)'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, parent TEXT, root TEXT, mtime REAL)'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS folder_files ('
+        'path TEXT PRIMARY KEY, directory TEXT, root TEXT, mtime REAL, size INTEGER)'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS loudness ('
+        'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, loudness REAL, peak REAL, power REAL, blocks INTEGER)'
+    )
+    connection.execute('CREATE INDEX IF NOT EXISTS metadata_album ON metadata (album)')
+    connection.execute('CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent)')
+    connection.execute('CREATE INDEX IF NOT EXISTS folders_root ON folders (root)')
+    connection.execute('CREATE INDEX IF NOT EXISTS folder_files_directory ON folder_files (directory)')
+    return connection
+
+
+class PersistenceService:
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._dirty = {}
+        self._closed = False
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self, target):
+        with self._condition:
+            if self._closed:
+                target.flush()
+                return
+            was_clean = not self._dirty
+            self._dirty[id(target)] = target
+            if was_clean:
+                self._condition.notify()
+
+    def flush(self):
+        # Held across the writes, so a caller returns only after a flush already in progress is done too.
+        with self._flush_lock:
+            with self._condition:
+                targets = list(self._dirty.values())
+                self._dirty.clear()
+            for target in targets:
+                target.flush()
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._dirty and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                self._condition.wait(self.interval)
+                if self._closed:
+                    return
+            self.flush()
 
 
 class Settings:
     SETTINGS_PATH = './userdata.data'
+    LIBRARY_PATH = './library.db'
     DEFAULT_PLAYLIST = 'default'
     DEFAULT_PLAYLIST_PATH = './playlists/default.playlist'
+    FLUSH_INTERVAL = 1.0
+    NOTIFY_INTERVAL = 1000
+    CROSSFADE = 0
+    REPLAY_GAIN = 'track'
+    CONTROL_SOCKET = './control.sock'
+    SHUFFLE = False
+    REPEAT = 'off'
+    RESCAN_DELAY = 500
+    POSITION_FRAME_INTERVAL = 100
 
     HEIGHT = 500
     FULL_WIDTH = 500
@@ -22,6 +317,9 @@ class Settings:
     PLAYLIST_WIDTH = 200
 
     def __init__(self):
+        self.persistence = None
+        self._lock = threading.Lock()
+
         if not os.path.exists(self.SETTINGS_PATH):
             with open(self.SETTINGS_PATH, 'w+') as f:
                 f.write(json.dumps({
@@ -33,28 +331,226 @@ class Settings:
             data = json.loads(f.read())
             self.default_playlist = data['default_playlist']
             self.opened_playlist = data['opened_playlist']
+            self.flush_interval = data.get('flush_interval', self.FLUSH_INTERVAL)
+            self.notify_interval = data.get('notify_interval', self.NOTIFY_INTERVAL)
+            self.crossfade = data.get('crossfade', self.CROSSFADE)
+            self.replay_gain = data.get('replay_gain', self.REPLAY_GAIN)
+            self.shuffle = data.get('shuffle', self.SHUFFLE)
+            self.repeat = data.get('repeat', self.REPEAT)
+            self.control_socket = data.get('control_socket', self.CONTROL_SOCKET)
+            self.watched_folders = data.get('watched_folders', {})
 
     def save(self):
-        with open(self.SETTINGS_PATH, 'w+') as f:
-            f.write(json.dumps({
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            data = json.dumps({
                 'default_playlist': self.default_playlist,
-                'opened_playlist': self.opened_playlist
-            }))
+                'opened_playlist': self.opened_playlist,
+                'flush_interval': self.flush_interval,
+                'notify_interval': self.notify_interval,
+                'crossfade': self.crossfade,
+                'replay_gain': self.replay_gain,
+                'shuffle': self.shuffle,
+                'repeat': self.repeat,
+                'control_socket': self.control_socket,
+                'watched_folders': dict(self.watched_folders)
+            })
+            atomic_write(self.SETTINGS_PATH, data)
 
     def set_opened_playlist(self, playlist):
         self.opened_playlist = playlist
         self.save()
 
+    def watch_folder(self, folder, playlist):
+        self.watched_folders[folder] = playlist
+        self.save()
+
+
+class RowRanges:
+
+    def __init__(self, ranges):
+        self.ranges = [list(row_range) for row_range in ranges]
+        self.starts = [start for start, stop in self.ranges]
+        self.before = list(accumulate((stop - start for start, stop in self.ranges), initial=0))
+        self.count = self.before[-1]
+
+    @classmethod
+    def from_rows(cls, rows):
+        ranges = []
+        for row in sorted(set(rows)):
+            if ranges and ranges[-1][1] == row:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([row, row + 1])
+        return cls(ranges)
+
+    def __contains__(self, row):
+        i = bisect_right(self.starts, row) - 1
+        return i >= 0 and row < self.ranges[i][1]
+
+    def rows(self):
+        return [row for start, stop in self.ranges for row in range(start, stop)]
+
+    def count_before(self, row):
+        i = bisect_right(self.starts, row) - 1
+        if i < 0:
+            return 0
+        start, stop = self.ranges[i]
+        return self.before[i] + min(row, stop) - start
+
+    def position(self, target):
+        return target - self.count_before(target)
+
+    def removed_row(self, row):
+        if row in self:
+            return -1
+        return row - self.count_before(row)
+
+    def moved_row(self, row, target):
+        position = self.position(target)
+        if row in self:
+            return position + self.count_before(row)
+        row -= self.count_before(row)
+        return row + self.count if row >= position else row
+
+    def move_in(self, items, target):
+        kept = items[:0]
+        moved = items[:0]
+        last = 0
+        for start, stop in self.ranges:
+            kept += items[last:start]
+            moved += items[start:stop]
+            last = stop
+        kept += items[last:]
+        position = self.position(target)
+        return kept[:position] + moved + kept[position:]
+
+
+class TrackStore:
+    ENCODING = 'utf-8'
+    ERRORS = 'surrogatepass'
+
+    def __init__(self):
+        self.directories = []
+        self.directory_ids = {}
+        self.directory_of = array('I')
+        self.names = bytearray()
+        self.offsets = array('I', [0])
+
+    def __len__(self):
+        return len(self.directory_of)
+
+    def intern(self, path):
+        return self.intern_all([path])[0]
+
+    def intern_all(self, paths):
+        first = len(self.directory_of)
+        directory_ids = self.directory_ids
+        directory_of = self.directory_of
+        names = []
+        separator = os.sep if os.sep != '/' else None
+        for path in paths:
+            split = path.rfind('/')
+            if separator is not None:
+                split = max(split, path.rfind(separator))
+            directory = path[:split + 1]
+            directory_id = directory_ids.get(directory)
+            if directory_id is None:
+                directory_id = directory_ids[directory] = len(self.directories)
+                self.directories.append(directory)
+            directory_of.append(directory_id)
+            names.append(path[split + 1:].encode(self.ENCODING, self.ERRORS))
+        offset = self.offsets[-1]
+        self.offsets.extend(offset + end for end in accumulate(map(len, names)))
+        self.names += b''.join(names)
+        return range(first, len(directory_of))
+
+    def name(self, track_id):
+        return self.names[self.offsets[track_id]:self.offsets[track_id + 1]].decode(self.ENCODING, self.ERRORS)
+
+    def path(self, track_id):
+        return self.directories[self.directory_of[track_id]] + self.name(track_id)
+
+    def memory_size(self):
+        columns = len(self.names) + (len(self.offsets) + len(self.directory_of)) * 4
+        return columns + sum(len(directory) + 120 for directory in self.directories)
+
+
+class TrackList:
+
+    def __init__(self, store, paths=()):
+        self.store = store
+        self.ids = array('I')
+        self.extend(paths)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        path = self.store.path
+        return (path(track_id) for track_id in self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            path = self.store.path
+            return [path(track_id) for track_id in self.ids[index]]
+        return self.store.path(self.ids[index])
+
+    def __setitem__(self, index, path):
+        self.ids[index] = self.store.intern(path)
+
+    def __delitem__(self, index):
+        del self.ids[index]
+
+    def remove_ranges(self, ranges):
+        for start, stop in reversed(ranges.ranges):
+            del self.ids[start:stop]
+
+    def move_ranges(self, ranges, target):
+        self.ids = ranges.move_in(self.ids, target)
+
+    def name(self, index):
+        return self.store.name(self.ids[index])
+
+    def copy(self):
+        # The store only ever grows, so a copy of the ids stays a consistent snapshot.
+        tracks = TrackList(self.store)
+        tracks.ids = array('I', self.ids)
+        return tracks
+
+    def memory_size(self):
+        return self.store.memory_size() + len(self.ids) * self.ids.itemsize
+
+    def append(self, path):
+        self.ids.append(self.store.intern(path))
+
+    def extend(self, paths):
+        self.ids.extend(self.store.intern_all(paths))
+
 
 class Playlist:
 
     BASE_PATH = './playlists/%s.playlist'
+    JOURNAL_SUFFIX = '.journal'
+    MIN_JOURNAL_SIZE = 1024 * 1024
 
-    def __init__(self, path = None, name = None):
+    def __init__(self, path = None, name = None, persistence = None, store = None):
         self.path = path
         self.name = name
-        self.tracks = []
+        self.store = store or TrackStore()
+        self.tracks = TrackList(self.store)
         self.current_track_index = 0
+        self.generation = 0
+        self.snapshot_size = 0
+        self.persistence = persistence
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
 
         if self.path:
             self.path = path
@@ -78,6 +574,10 @@ class Playlist:
             else:
                 self.load()
 
+    @property
+    def journal_path(self):
+        return self.path + self.JOURNAL_SUFFIX
+
     def new(self):
         if not os.path.exists(os.path.dirname(self.path)):
             os.makedirs(os.path.dirname(self.path))
@@ -89,52 +589,1903 @@ class Playlist:
         self.save()
     
     def add_item(self, item):
-        self.tracks.append(item)
-        self.save()
+        with self._lock:
+            self.tracks.append(item)
+            self._pending.append({'op': 'add', 'items': [item]})
+        self.mark_dirty()
 
     def add_items(self, items):
-        self.tracks.extend(items)
-        self.save()
+        with self._lock:
+            self.tracks.extend(items)
+            self._pending.append({'op': 'add', 'items': list(items)})
+        self.mark_dirty()
 
     def remove_item(self, index):
-        del self.tracks[index]
-        self.save()
+        with self._lock:
+            del self.tracks[index]
+            self._pending.append({'op': 'remove', 'index': index})
+        self.mark_dirty()
+
+    def remove_ranges(self, ranges):
+        with self._lock:
+            self.tracks.remove_ranges(ranges)
+            if ranges.count == 1:
+                self._pending.append({'op': 'remove', 'index': ranges.starts[0]})
+            else:
+                self._pending.append({'op': 'remove_ranges', 'ranges': ranges.ranges})
+        self.mark_dirty()
+
+    def move_ranges(self, ranges, target):
+        with self._lock:
+            self.tracks.move_ranges(ranges, target)
+            self._pending.append({'op': 'move_ranges', 'ranges': ranges.ranges, 'target': target})
+        self.mark_dirty()
+
+    def replace_item(self, index, item):
+        with self._lock:
+            self.tracks[index] = item
+            self._pending.append({'op': 'replace', 'index': index, 'item': item})
+        self.mark_dirty()
+
+    def apply_folder_changes(self, added, removed, moved):
+        operation = {'op': 'folder_changes', 'added': list(added), 'removed': list(removed), 'moved': list(moved)}
+        with self._lock:
+            added = self.change_paths(operation['added'], operation['removed'], operation['moved'])
+            self._pending.append(operation)
+        self.mark_dirty()
+        return added
+
+    def change_paths(self, added, removed, moved):
+        # Watched folder changes are journaled by path, so they can be appended without loading the playlist.
+        positions = {track: row for row, track in enumerate(self.tracks)}
+        for source, target in moved:
+            if source in positions and target not in positions:
+                self.tracks[positions[source]] = target
+                positions[target] = positions.pop(source)
+        ranges = RowRanges.from_rows(positions[path] for path in removed if path in positions)
+        if ranges.count:
+            self.tracks.remove_ranges(ranges)
+        added = [path for path in added if path not in positions]
+        self.tracks.extend(added)
+        return added
 
     def set_current_track_index(self, index):
-        self.current_track_index = index
-        self.save()
+        with self._lock:
+            self.current_track_index = index
+            if self._pending and self._pending[-1]['op'] == 'index':
+                self._pending[-1]['value'] = index
+            else:
+                self._pending.append({'op': 'index', 'value': index})
+        self.mark_dirty()
+
+    def apply(self, operation):
+        if operation['op'] == 'add':
+            self.tracks.extend(operation['items'])
+        elif operation['op'] == 'remove':
+            del self.tracks[operation['index']]
+        elif operation['op'] == 'remove_ranges':
+            self.tracks.remove_ranges(RowRanges(operation['ranges']))
+        elif operation['op'] == 'move_ranges':
+            self.tracks.move_ranges(RowRanges(operation['ranges']), operation['target'])
+        elif operation['op'] == 'replace':
+            self.tracks[operation['index']] = operation['item']
+        elif operation['op'] == 'index':
+            self.current_track_index = operation['value']
+        elif operation['op'] == 'folder_changes':
+            self.change_paths(operation['added'], operation['removed'], operation['moved'])
+
+    def mark_dirty(self):
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                operations, self._pending = self._pending, []
+            if not operations:
+                return
+
+            with open(self.journal_path, 'a') as f:
+                if f.tell() == 0:
+                    f.write(json.dumps({'generation': self.generation}) + '\n')
+                f.write(''.join(json.dumps(operation) + '\n' for operation in operations))
+                f.flush()
+                os.fsync(f.fileno())
+                journal_size = f.tell()
+
+            if journal_size > max(self.MIN_JOURNAL_SIZE, self.snapshot_size):
+                self._write_snapshot()
 
     def save(self):
-        with open(self.path, 'w+') as f:
-            f.write(json.dumps({
+        with self._flush_lock:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        with self._lock:
+            self._pending = []
+            self.generation += 1
+            snapshot = {
                 'name': self.name,
-                'tracks': self.tracks,
-                'current_track_index': self.current_track_index
-            }))
+                'tracks': list(self.tracks),
+                'current_track_index': self.current_track_index,
+                'generation': self.generation
+            }
+        data = json.dumps(snapshot)
+        atomic_write(self.path, data)
+        self.snapshot_size = len(data)
+        self._reset_journal()
+
+    def _reset_journal(self):
+        atomic_write(self.journal_path, json.dumps({'generation': self.generation}) + '\n')
 
     def load(self):
         with open(self.path) as f:
             data = json.loads(f.read())
             self.name = data['name']
-            self.tracks = data['tracks']
+            self.tracks = TrackList(self.store, data['tracks'])
             self.current_track_index = data['current_track_index']
+            self.generation = data.get('generation', 0)
+            self.snapshot_size = f.tell()
+
+        if 'generation' not in data:
+            self.save()
+            return
+
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path) as f:
+            header = f.readline()
+            try:
+                stale = json.loads(header)['generation'] != self.generation
+            except (ValueError, KeyError, TypeError):
+                stale = True
+            if stale:
+                # Left over from a crash between the snapshot and the journal reset, later appends would be ignored.
+                f.close()
+                self._reset_journal()
+                return
+            for line in f:
+                try:
+                    self.apply(json.loads(line))
+                except (ValueError, KeyError, IndexError):
+                    # A torn write at the tail, later appends would land after it.
+                    self.save()
+                    break
+
+class JournalWriter:
+
+    def __init__(self, path, persistence=None):
+        self.path = path
+        self.persistence = persistence
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @property
+    def journal_path(self):
+        return self.path + Playlist.JOURNAL_SUFFIX
+
+    def append(self, operation):
+        with self._lock:
+            self._pending.append(operation)
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            operations, self._pending = self._pending, []
+        if not operations:
+            return
+        try:
+            with open(self.journal_path, 'r+') as f:
+                if not f.readline():
+                    raise OSError
+                f.seek(0, os.SEEK_END)
+                f.write(''.join(json.dumps(operation) + '\n' for operation in operations))
+                f.flush()
+                os.fsync(f.fileno())
+            return
+        except OSError:
+            pass
+        # Without a journal header only the snapshot knows its generation, so the playlist is read after all.
+        playlist = Playlist(path=self.path)
+        for operation in operations:
+            playlist.apply_folder_changes(operation['added'], operation['removed'], operation['moved'])
+
+
+class SearchIndex:
+    GRAM_SIZES = (2, 3)
+    MIN_COMPACT_SIZE = 1000
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = []
+        self.texts = []
+        self.postings = {}
+        self.dead = 0
+        self._row_of = None
+
+    @classmethod
+    def grams(cls, text):
+        return {text[i:i + size] for size in cls.GRAM_SIZES for i in range(len(text) - size + 1)}
+
+    @classmethod
+    def query_grams(cls, word):
+        size = min(len(word), cls.GRAM_SIZES[-1])
+        return {word[i:i + size] for i in range(len(word) - size + 1)}
+
+    def add_text(self, text):
+        text_id = len(self.texts)
+        self.texts.append(text)
+        for gram in self.grams(text):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(text_id)
+        return text_id
+
+    def append(self, text):
+        self.ids.append(self.add_text(text))
+        if self._row_of is not None:
+            self._row_of[self.ids[-1]] = len(self.ids) - 1
+
+    def remove(self, row):
+        self.remove_range(row, row + 1)
+
+    def remove_range(self, start, stop):
+        removed = self.ids[start:stop]
+        for text_id in removed:
+            self.texts[text_id] = None
+        del self.ids[start:stop]
+        self.dead += len(removed)
+        self._row_of = None
+        self.compact()
+
+    def move_ranges(self, ranges, target):
+        self.ids = ranges.move_in(self.ids, target)
+        self._row_of = None
+
+    def replace(self, row, text):
+        self.texts[self.ids[row]] = None
+        self.dead += 1
+        self.ids[row] = self.add_text(text)
+        if self._row_of is not None:
+            self._row_of[self.ids[row]] = row
+        self.compact()
+
+    def compact(self):
+        if self.dead < max(self.MIN_COMPACT_SIZE, len(self.ids)):
+            return
+        texts = [self.texts[text_id] for text_id in self.ids]
+        self.clear()
+        for text in texts:
+            self.append(text)
+
+    def memory_size(self):
+        texts = sum(len(text) + 57 for text in self.texts if text is not None)
+        postings = sum(len(posting) * posting.itemsize + 180 for posting in self.postings.values())
+        return texts + postings + len(self.ids) * 36
+
+    def row_of(self):
+        if self._row_of is None:
+            self._row_of = {text_id: row for row, text_id in enumerate(self.ids)}
+        return self._row_of
+
+    def search(self, words):
+        texts = self.texts
+        posting = None
+        for word in words:
+            if len(word) < self.GRAM_SIZES[0]:
+                continue
+            for gram in self.query_grams(word):
+                candidates = self.postings.get(gram)
+                if candidates is None:
+                    return []
+                if posting is None or len(candidates) < len(posting):
+                    posting = candidates
+
+        if posting is None:
+            # One-letter words have no grams, so every live text is checked.
+            return [row for row, text_id in enumerate(self.ids) if all(word in texts[text_id] for word in words)]
+
+        row_of = self.row_of()
+        rows = [
+            row_of[text_id] for text_id in posting
+            if texts[text_id] is not None and all(word in texts[text_id] for word in words)
+        ]
+        rows.sort()
+        return rows
+
+
+class PlaylistCache:
+    BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, budget=BUDGET):
+        self.budget = budget
+        self.size = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(path):
+        return os.path.abspath(path)
+
+    def put(self, playlist, search_index=None):
+        key = self.key(playlist.path)
+        self.discard(key)
+        cost = playlist.tracks.memory_size()
+        if search_index is not None:
+            cost += search_index.memory_size()
+        self._entries[key] = (playlist, search_index, cost)
+        self.size += cost
+        while self._entries and self.size > self.budget:
+            self.size -= self._entries.popitem(last=False)[1][2]
+
+    def take(self, path):
+        entry = self._entries.pop(self.key(path), None)
+        if entry is None:
+            return None, None
+        self.size -= entry[2]
+        return entry[0], entry[1]
+
+    def peek(self, path):
+        entry = self._entries.get(self.key(path))
+        return entry[0] if entry is not None else None
+
+    def discard(self, path):
+        entry = self._entries.pop(self.key(path), None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate_index(self, path):
+        key = self.key(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None:
+            self._entries[key] = (entry[0], None, entry[2])
+
 
 class PlaylistModel(QAbstractListModel):
-    def __init__(self, playlist, *args, **kwargs):
+    FETCH_SIZE = 1000
+    ROWS_MIME_TYPE = 'application/x-music-player-rows'
+    INDEX_CHUNK_SIZE = 200
+    INDEX_TIME_BUDGET = 0.01
+
+    tracks_changed = pyqtSignal()
+
+    def __init__(self, playlist, metadata=None, searchable=True, *args, **kwargs):
         super(PlaylistModel, self).__init__(*args, **kwargs)
         self.playlist = playlist
-
-    def data(self, index, role):
+        self.metadata = metadata
+        self.searchable = searchable
+        self.titles = []
+        self.search_index = SearchIndex()
+        self._rows_by_path = None
+        self._index_timer = QTimer(self)
+        self._index_timer.timeout.connect(self.index_more)
+        self.fetch(self.FETCH_SIZE)
+
+    def tagged_title(self, track):
+        if self.metadata is not None:
+            record = self.metadata.get(track)
+            if record is not None and record['title']:
+                if record['artist']:
+                    return '%s - %s' % (record['artist'], record['title'])
+                return record['title']
+        return None
+
+    def title(self, track):
+        return self.tagged_title(track) or os.path.basename(track)
+
+    def row_title(self, row):
+        # Untagged rows keep None and read their file name from the track store when displayed.
+        return self.tagged_title(self.playlist.tracks[row])
+
+    def search_text(self, track):
+        text = os.path.basename(track)
+        title = self.title(track)
+        if title != text:
+            text += '\n' + title
+        return text.lower()
+
+    def index_more(self):
+        if self.playlist is None or not self.searchable:
+            self._index_timer.stop()
+            return
+        tracks = self.playlist.tracks
+        deadline = time.perf_counter() + self.INDEX_TIME_BUDGET
+        while time.perf_counter() < deadline:
+            first = len(self.search_index.ids)
+            last = min(first + self.INDEX_CHUNK_SIZE, len(tracks))
+            for track in tracks[first:last]:
+                self.search_index.append(self.search_text(track))
+            if last >= len(tracks):
+                self._index_timer.stop()
+                return
+
+    def search(self, query):
+        words = query.lower().split()
+        if not words or self.playlist is None:
+            return None
+        rows = self.search_index.search(words)
+        first = len(self.search_index.ids)
+        for row, track in enumerate(self.playlist.tracks[first:], first):
+            text = self.search_text(track)
+            if all(word in text for word in words):
+                rows.append(row)
+        return rows
+
+    def data(self, index, role=Qt.DisplayRole):
         if role == Qt.DisplayRole:
-            media = self.playlist.media(index.row())
-            return media.canonicalUrl().fileName()
+            title = self.titles[index.row()]
+            if title is None:
+                return self.playlist.tracks.name(index.row())
+            return title
     
-    def rowCount(self, index):
-        return self.playlist.mediaCount()
+    def rowCount(self, index=QModelIndex()):
+        if index.isValid():
+            return 0
+        return len(self.titles)
+
+    def canFetchMore(self, index):
+        if index.isValid() or self.playlist is None:
+            return False
+        return len(self.titles) < len(self.playlist.tracks)
+
+    def fetchMore(self, index):
+        self.fetch(self.FETCH_SIZE)
+
+    def fetch(self, count):
+        if self.playlist is None:
+            return
+        first = len(self.titles)
+        last = min(first + count, len(self.playlist.tracks))
+        if last <= first:
+            return
+        self.beginInsertRows(QModelIndex(), first, last - 1)
+        self.titles.extend(self.row_title(row) for row in range(first, last))
+        self.endInsertRows()
+
+    def ensure_fetched(self, row):
+        if row >= len(self.titles):
+            self.fetch(row + 1 - len(self.titles))
+
+    def set_playlist(self, playlist, search_index=None):
+        self.beginResetModel()
+        self.playlist = playlist
+        self.titles = []
+        self._rows_by_path = None
+        # The previous index may be kept by the playlist cache, so it is replaced rather than cleared.
+        self.search_index = search_index if search_index is not None else SearchIndex()
+        self.endResetModel()
+        self.fetch(self.FETCH_SIZE)
+        self._index_timer.start()
+        self.tracks_changed.emit()
+
+    def tracks_appended(self, count):
+        tracks = self.playlist.tracks
+        if len(self.titles) == len(tracks) - count:
+            self.fetch(min(count, self.FETCH_SIZE))
+        if self.searchable and count <= self.INDEX_CHUNK_SIZE and len(self.search_index.ids) == len(tracks) - count:
+            for track in tracks[-count:]:
+                self.search_index.append(self.search_text(track))
+        else:
+            self._index_timer.start()
+        if self._rows_by_path is not None:
+            self.map_rows(len(tracks) - count)
+        self.tracks_changed.emit()
+
+    def metadata_changed(self, paths):
+        if self.playlist is None:
+            return
+        tracks = self.playlist.tracks
+        rows = self.rows_of(set(paths))
+        indexed = len(self.search_index.ids)
+        for row in rows:
+            if row < indexed:
+                self.search_index.replace(row, self.search_text(tracks[row]))
+
+        changed = [row for row in rows if row < len(self.titles)]
+        for row in changed:
+            self.titles[row] = self.row_title(row)
+        if changed:
+            self.dataChanged.emit(self.index(changed[0]), self.index(changed[-1]), [Qt.DisplayRole])
+        self.tracks_changed.emit()
+
+    def rows_of(self, paths):
+        # Built once and kept until rows are removed, moved or replaced, so metadata chunks do not rescan the playlist.
+        if self._rows_by_path is None:
+            self._rows_by_path = {}
+            self.map_rows(0)
+        rows = []
+        for path in paths:
+            rows.extend(self._rows_by_path.get(path, ()))
+        rows.sort()
+        return rows
+
+    def map_rows(self, first):
+        rows_by_path = self._rows_by_path
+        tracks = self.playlist.tracks[first:]
+        expected = len(rows_by_path) + len(tracks)
+        rows_by_path.update(zip(tracks, zip(range(first, first + len(tracks)))))
+        if len(rows_by_path) < expected:
+            # Some path is listed more than once, so every row is collected again the slow way.
+            rows_by_path.clear()
+            for row, track in enumerate(self.playlist.tracks):
+                rows_by_path[track] = rows_by_path.get(track, ()) + (row,)
+
+    def track_replaced(self, row, old):
+        track = self.playlist.tracks[row]
+        if self._rows_by_path is not None:
+            rows = tuple(other for other in self._rows_by_path.pop(old, ()) if other != row)
+            if rows:
+                self._rows_by_path[old] = rows
+            self._rows_by_path[track] = self._rows_by_path.get(track, ()) + (row,)
+        if row < len(self.search_index.ids):
+            self.search_index.replace(row, self.search_text(track))
+        if row < len(self.titles):
+            self.titles[row] = self.row_title(row)
+            self.dataChanged.emit(self.index(row), self.index(row), [Qt.DisplayRole])
+        self.tracks_changed.emit()
+
+    def track_removed(self, row):
+        self.tracks_removed(RowRanges([(row, row + 1)]))
+
+    def tracks_removed(self, ranges):
+        self._rows_by_path = None
+        for start, stop in reversed(ranges.ranges):
+            if start < len(self.titles):
+                end = min(stop, len(self.titles))
+                self.beginRemoveRows(QModelIndex(), start, end - 1)
+                del self.titles[start:end]
+                self.endRemoveRows()
+            if start < len(self.search_index.ids):
+                self.search_index.remove_range(start, stop)
+        self.tracks_changed.emit()
+
+    def tracks_moved(self, ranges, target):
+        self._rows_by_path = None
+        last = max(ranges.ranges[-1][1], target)
+        first = min(ranges.ranges[0][0], target)
+        if last <= len(self.titles):
+            self.layoutAboutToBeChanged.emit()
+            self.titles = ranges.move_in(self.titles, target)
+            indexes = self.persistentIndexList()
+            self.changePersistentIndexList(indexes, [
+                self.index(ranges.moved_row(index.row(), target)) for index in indexes
+            ])
+            self.layoutChanged.emit()
+        elif first < len(self.titles):
+            # Rows past the fetched part move too, so the affected tail is dropped and fetched again.
+            self.beginRemoveRows(QModelIndex(), first, len(self.titles) - 1)
+            del self.titles[first:]
+            self.endRemoveRows()
+
+        if last <= len(self.search_index.ids):
+            self.search_index.move_ranges(ranges, target)
+        elif first < len(self.search_index.ids):
+            self.search_index.remove_range(first, len(self.search_index.ids))
+            self._index_timer.start()
+        self.tracks_changed.emit()
+
+    def flags(self, index):
+        flags = super(PlaylistModel, self).flags(index)
+        if index.isValid():
+            return flags | Qt.ItemIsDragEnabled
+        return flags | Qt.ItemIsDropEnabled
+
+    def supportedDropActions(self):
+        return Qt.MoveAction
+
+    def mimeTypes(self):
+        return [self.ROWS_MIME_TYPE]
+
+    def mimeData(self, indexes):
+        # Drops are only accepted from the playlist view itself, which reads its own selection.
+        data = QMimeData()
+        data.setData(self.ROWS_MIME_TYPE, b'')
+        return data
+
+
+class PlaylistFilterModel(QAbstractListModel):
+
+    def __init__(self, source, *args, **kwargs):
+        super(PlaylistFilterModel, self).__init__(*args, **kwargs)
+        self.source = source
+        self.rows = []
+        self.fetched = 0
+
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self.fetched = min(len(rows), PlaylistModel.FETCH_SIZE)
+        self.endResetModel()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            return self.source.title(self.source.playlist.tracks[self.rows[index.row()]])
+
+    def rowCount(self, index=QModelIndex()):
+        if index.isValid():
+            return 0
+        return self.fetched
+
+    def canFetchMore(self, index):
+        return not index.isValid() and self.fetched < len(self.rows)
+
+    def fetchMore(self, index):
+        last = min(self.fetched + PlaylistModel.FETCH_SIZE, len(self.rows))
+        self.beginInsertRows(QModelIndex(), self.fetched, last - 1)
+        self.fetched = last
+        self.endInsertRows()
+
+    def source_row(self, row):
+        return self.rows[row]
+
+    def filter_row(self, source_row):
+        row = bisect_left(self.rows, source_row)
+        if row < len(self.rows) and self.rows[row] == source_row:
+            if row >= self.fetched:
+                self.beginInsertRows(QModelIndex(), self.fetched, row)
+                self.fetched = row + 1
+                self.endInsertRows()
+            return row
+        return -1
 
 
 class PlaylistEvents(QObject):
+    playlist_loaded = pyqtSignal(Playlist)
     playlist_changed = pyqtSignal(Playlist)
+    current_index_changed = pyqtSignal(int)
+    duration_changed = pyqtSignal('qint64')
+    position_changed = pyqtSignal('qint64')
+    metadata_changed = pyqtSignal()
+
+
+class PlaylistLoader(QThread):
+    loaded = pyqtSignal(Playlist)
+
+    def __init__(self, path, persistence=None, parent=None):
+        super(PlaylistLoader, self).__init__(parent)
+        self.path = path
+        self.persistence = persistence
+
+    def run(self):
+        self.loaded.emit(Playlist(path=self.path, persistence=self.persistence))
+
+
+class HashEntry:
+    __slots__ = ('path', 'mtime', 'size', 'partial', 'full', 'checked')
+
+    def __init__(self, path, mtime, size, checked=True):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.partial = None
+        self.full = None
+        self.checked = checked
+
+
+class DuplicateFilter:
+
+    def __init__(self, path=Settings.LIBRARY_PATH, workers=None):
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self.real_paths = set()
+        self.by_size = {}
+        self._connection = None
+        self._pool = None
+
+    def close(self):
+        close_pool(self._pool)
+        self._pool = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def entry(self, path):
+        real_path = os.path.realpath(path)
+        if real_path in self.real_paths or path in self.real_paths:
+            return None
+        try:
+            stat = os.stat(real_path)
+        except OSError:
+            return None
+        self.real_paths.add(real_path)
+        return HashEntry(path, stat.st_mtime, stat.st_size)
+
+    def add_existing(self, paths):
+        # Sizes of indexed tracks come from the library, they are only checked on disk once a new file collides.
+        paths = set(paths)
+        self.real_paths.update(paths)
+        if self._connection is None:
+            self._connection = connect_library(self.path)
+        rows = self._connection.execute(
+            'SELECT path, mtime, size FROM metadata UNION ALL SELECT path, mtime, size FROM hashes'
+        )
+        for path, mtime, size in rows:
+            if path in paths:
+                paths.discard(path)
+                self.by_size.setdefault(size, []).append(HashEntry(path, mtime, size, checked=False))
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self.by_size.setdefault(stat.st_size, []).append(HashEntry(path, stat.st_mtime, stat.st_size))
+
+    def check(self, size):
+        entries = self.by_size.get(size, [])
+        if all(entry.checked for entry in entries):
+            return
+        self.by_size[size] = []
+        for entry in entries:
+            if not entry.checked:
+                try:
+                    stat = os.stat(entry.path)
+                except OSError:
+                    continue
+                entry.mtime, entry.size, entry.checked = stat.st_mtime, stat.st_size, True
+            self.by_size.setdefault(entry.size, []).append(entry)
+        if not self.by_size[size]:
+            del self.by_size[size]
+
+    def unique(self, paths):
+        entries = [entry for entry in map(self.entry, paths) if entry is not None]
+
+        sizes = {}
+        for entry in entries:
+            sizes[entry.size] = sizes.get(entry.size, 0) + 1
+        for size in sizes:
+            if size in self.by_size:
+                self.check(size)
+        colliding = [entry for entry in entries if sizes[entry.size] > 1 or entry.size in self.by_size]
+        for size in {entry.size for entry in colliding}:
+            colliding.extend(self.by_size.get(size, []))
+        self.hash(colliding, 'partial', partial_hash)
+
+        unique = []
+        for entry in entries:
+            same = [other for other in self.by_size.get(entry.size, []) if other.partial == entry.partial]
+            if same:
+                self.hash(same + [entry], 'full', full_hash)
+                if any(other.full == entry.full for other in same):
+                    continue
+            self.by_size.setdefault(entry.size, []).append(entry)
+            unique.append(entry.path)
+        return unique
+
+    def hash(self, entries, field, function):
+        entries = [entry for entry in entries if getattr(entry, field) is None]
+        if not entries:
+            return
+
+        if self._connection is None:
+            self._connection = connect_library(self.path)
+        missing = []
+        for entry in entries:
+            row = self._connection.execute(
+                'SELECT partial, full FROM hashes WHERE path = ? AND mtime = ? AND size = ?',
+                (entry.path, entry.mtime, entry.size)
+            ).fetchone()
+            if row is not None:
+                entry.partial = entry.partial or row[0]
+                entry.full = entry.full or row[1]
+            if getattr(entry, field) is None:
+                missing.append(entry)
+        if not missing:
+            return
+
+        if self._pool is None:
+            self._pool = worker_pool(self.workers)
+        for entry, digest in zip(missing, self._pool.map(function, [entry.path for entry in missing])):
+            setattr(entry, field, digest or '')
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+            [(entry.path, entry.mtime, entry.size, entry.partial, entry.full) for entry in missing]
+        )
+        self._connection.commit()
+
+
+class FolderScanner(QThread):
+    CHUNK_SIZE = 500
+    PROGRESS_TEXT = 'Added %d files, skipped %d duplicates...'
+
+    chunk_found = pyqtSignal(list)
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, folder, extensions, existing=(), files=None, workers=None, parent=None):
+        super(FolderScanner, self).__init__(parent)
+        self.folder = folder
+        self.extensions = tuple(extensions)
+        # Track lists are only decoded in the scanner thread.
+        self.existing = existing.copy() if isinstance(existing, TrackList) else list(existing)
+        self.files = files
+        self.workers = workers
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def walk(self):
+        if self.files is not None:
+            for file in self.files:
+                if os.path.splitext(file)[1].lower() in self.extensions:
+                    yield file
+            return
+
+        directories = [self.folder]
+        while directories and not self._cancelled:
+            try:
+                with os.scandir(directories.pop()) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                if os.path.splitext(entry.name)[1].lower() in self.extensions:
+                    yield entry.path
+            directories.extend(reversed(subdirectories))
+
+    def run(self):
+        added = 0
+        duplicates = 0
+        chunk = []
+        duplicate_filter = DuplicateFilter(workers=self.workers)
+        duplicate_filter.add_existing(self.existing)
+        try:
+            for path in self.walk():
+                chunk.append(path)
+                if len(chunk) >= self.CHUNK_SIZE:
+                    unique = duplicate_filter.unique(chunk)
+                    added, duplicates = self.commit(unique, added + len(unique), duplicates + len(chunk) - len(unique))
+                    chunk = []
+                if self._cancelled:
+                    return
+
+            if chunk:
+                unique = duplicate_filter.unique(chunk)
+                self.commit(unique, added + len(unique), duplicates + len(chunk) - len(unique))
+        finally:
+            duplicate_filter.close()
+
+    def commit(self, unique, added, duplicates):
+        if unique and not self._cancelled:
+            self.chunk_found.emit(unique)
+        self.progress.emit(added, duplicates)
+        return added, duplicates
+
+
+class PlaylistImporter(QThread):
+    FORMATS = ('.m3u', '.m3u8', '.pls')
+    CHUNK_SIZE = 500
+    MAX_PENDING_CHUNKS = 4
+    WAIT_INTERVAL = 0.1
+    PROGRESS_TEXT = 'Added %d tracks, skipped %d entries...'
+
+    chunk_found = pyqtSignal(list)
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, path, extensions, parent=None):
+        super(PlaylistImporter, self).__init__(parent)
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.extensions = tuple(extensions)
+        self._pending = threading.Semaphore(self.MAX_PENDING_CHUNKS)
+        self._cancelled = False
+        self.chunk_found.connect(self.consumed)
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def consumed(self):
+        self._pending.release()
+
+    def lines(self):
+        with open(self.path, encoding='utf-8-sig', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+    def entries(self):
+        if os.path.splitext(self.path)[1].lower() == '.pls':
+            for line in self.lines():
+                key, separator, value = line.partition('=')
+                if separator and key.lower().startswith('file'):
+                    yield value.strip()
+            return
+        for line in self.lines():
+            if not line.startswith('#'):
+                yield line
+
+    def resolve(self, entry):
+        if '://' in entry:
+            url = QUrl(entry)
+            return url.toLocalFile() if url.isLocalFile() else None
+        if os.sep == '/' and '\\' in entry and '/' not in entry:
+            entry = entry.replace('\\', '/')
+        return os.path.normpath(os.path.join(self.directory, os.path.expanduser(entry)))
+
+    def run(self):
+        added = 0
+        skipped = 0
+        chunk = []
+        try:
+            for entry in self.entries():
+                path = self.resolve(entry)
+                if path is None or os.path.splitext(path)[1].lower() not in self.extensions:
+                    skipped += 1
+                    continue
+                chunk.append(path)
+                if len(chunk) >= self.CHUNK_SIZE:
+                    added += len(chunk)
+                    self.commit(chunk, added, skipped)
+                    chunk = []
+                if self._cancelled:
+                    return
+        except OSError:
+            pass
+        if chunk:
+            self.commit(chunk, added + len(chunk), skipped)
+
+    def commit(self, chunk, added, skipped):
+        # Each chunk in flight holds a slot until the UI thread has added it, which keeps memory bounded.
+        while not self._pending.acquire(timeout=self.WAIT_INTERVAL):
+            if self._cancelled:
+                return
+        if self._cancelled:
+            return
+        self.chunk_found.emit(chunk)
+        self.progress.emit(added, skipped)
+
+
+class PlaylistExporter(QThread):
+    FORMATS = PlaylistImporter.FORMATS
+
+    def __init__(self, tracks, path, parent=None):
+        super(PlaylistExporter, self).__init__(parent)
+        # The store only ever grows, so a copy of the ids is a consistent snapshot.
+        self.store = tracks.store
+        self.ids = array('I', tracks.ids)
+        self.path = path
+        self.prefix = os.path.join(os.path.dirname(os.path.abspath(path)), '')
+        self.failed = False
+
+    def entry(self, track):
+        return track[len(self.prefix):] if track.startswith(self.prefix) else track
+
+    def lines(self):
+        tracks = (self.entry(self.store.path(track_id)) for track_id in self.ids)
+        if os.path.splitext(self.path)[1].lower() == '.pls':
+            yield '[playlist]\n'
+            for number, track in enumerate(tracks, 1):
+                yield 'File%d=%s\n' % (number, track)
+            yield 'NumberOfEntries=%d\nVersion=2\n' % len(self.ids)
+            return
+        yield '#EXTM3U\n'
+        for track in tracks:
+            yield track + '\n'
+
+    def run(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                f.writelines(self.lines())
+            os.replace(tmp_path, self.path)
+        except (OSError, UnicodeError):
+            self.failed = True
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class FolderWatcher(QThread):
+    changes_found = pyqtSignal(str, list, list, list)
+    directories_found = pyqtSignal(list)
+
+    def __init__(self, extensions, path=Settings.LIBRARY_PATH, parent=None):
+        super(FolderWatcher, self).__init__(parent)
+        self.extensions = tuple(extensions)
+        self.path = path
+        self._queue = queue.Queue()
+
+    def sync(self, root):
+        self._queue.put(('sync', root))
+
+    def rescan(self, directories):
+        self._queue.put(('rescan', list(directories)))
+
+    def stop(self):
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        connection = connect_library(self.path)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            changes = {}
+            found = []
+            if job[0] == 'sync':
+                self.sync_root(connection, job[1], changes, found)
+            else:
+                for directory in job[1]:
+                    row = connection.execute('SELECT root FROM folders WHERE path = ?', (directory,)).fetchone()
+                    if row is not None:
+                        self.scan_directory(connection, directory, row[0], changes, found)
+            connection.commit()
+
+            if found:
+                self.directories_found.emit(found)
+            for root, (added, removed) in changes.items():
+                self.emit_changes(root, added, removed)
+        connection.close()
+
+    def sync_root(self, connection, root, changes, found):
+        directories = connection.execute('SELECT path, mtime FROM folders WHERE root = ?', (root,)).fetchall()
+        if not directories:
+            self.scan_directory(connection, root, root, changes, found)
+            return
+
+        found.extend(directory for directory, mtime in directories)
+        for directory, mtime in directories:
+            try:
+                changed = os.stat(directory).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self.scan_directory(connection, directory, root, changes, found)
+
+    def scan_directory(self, connection, directory, root, changes, found):
+        added, removed = changes.setdefault(root, ({}, {}))
+        known = {
+            path: (mtime, size) for path, mtime, size in connection.execute(
+                'SELECT path, mtime, size FROM folder_files WHERE directory = ?', (directory,)
+            )
+        }
+        known_directories = {
+            path for path, in connection.execute('SELECT path FROM folders WHERE parent = ?', (directory,))
+        }
+
+        files = {}
+        directories = set()
+        try:
+            mtime = os.stat(directory).st_mtime
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.add(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in self.extensions:
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime, stat.st_size)
+                    except OSError:
+                        continue
+        except OSError:
+            mtime = None
+
+        for path in known.keys() - files.keys():
+            removed[path] = known[path]
+        for path in files.keys() - known.keys():
+            added[path] = files[path]
+        connection.executemany('DELETE FROM folder_files WHERE path = ?', [(path,) for path in known.keys() - files.keys()])
+        connection.executemany(
+            'INSERT OR REPLACE INTO folder_files VALUES (?, ?, ?, ?, ?)',
+            [
+                (path, directory, root, file_mtime, size)
+                for path, (file_mtime, size) in files.items() if known.get(path) != (file_mtime, size)
+            ]
+        )
+
+        for subdirectory in known_directories - directories:
+            self.scan_directory(connection, subdirectory, root, changes, found)
+
+        if mtime is None:
+            connection.execute('DELETE FROM folders WHERE path = ?', (directory,))
+            return
+        if directory not in known_directories and connection.execute(
+            'SELECT 1 FROM folders WHERE path = ?', (directory,)
+        ).fetchone() is None:
+            found.append(directory)
+        connection.execute(
+            'INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+            (directory, os.path.dirname(directory), root, mtime)
+        )
+        for subdirectory in directories - known_directories:
+            self.scan_directory(connection, subdirectory, root, changes, found)
+
+    def emit_changes(self, root, added, removed):
+        by_signature = {}
+        for path, signature in removed.items():
+            by_signature.setdefault(signature, []).append(path)
+
+        moved = []
+        for path in sorted(added):
+            sources = by_signature.get(added[path])
+            if sources:
+                names = [os.path.basename(source) for source in sources]
+                name = os.path.basename(path)
+                source = sources.pop(names.index(name) if name in names else -1)
+                moved.append([source, path])
+        moved_sources = {source for source, target in moved}
+        moved_targets = {target for source, target in moved}
+
+        added = sorted(path for path in added if path not in moved_targets)
+        removed = [path for path in removed if path not in moved_sources]
+        if added or removed or moved:
+            self.changes_found.emit(root, added, removed, moved)
+
+
+class MetadataIndex:
+    PATH = Settings.LIBRARY_PATH
+    FIELDS = ('title', 'artist', 'album', 'album_artist', 'duration')
+    CACHE_SIZE = 10000
+
+    def __init__(self, path=PATH):
+        self.path = path
+        self._cache = OrderedDict()
+        self._connection = connect_library(path)
+
+    def get(self, path):
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            return self._cache[path]
+        row = self._connection.execute(
+            'SELECT title, artist, album, album_artist, duration FROM metadata WHERE path = ?', (path,)
+        ).fetchone()
+        record = dict(zip(self.FIELDS, row)) if row else None
+        self.remember(path, record)
+        return record
+
+    def update(self, records):
+        for record in records:
+            if record['path'] in self._cache:
+                self.remember(record['path'], {field: record[field] for field in self.FIELDS})
+
+    def remember(self, path, record):
+        # Titles of fetched rows live in the model, so only recent lookups are kept here.
+        self._cache[path] = record
+        self._cache.move_to_end(path)
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        self._connection.close()
+
+
+class MetadataIndexer(QThread):
+    CHUNK_SIZE = 200
+    IDLE_TIMEOUT = 5
+
+    indexed = pyqtSignal(list)
+
+    def __init__(self, path=MetadataIndex.PATH, workers=None, parent=None):
+        super(MetadataIndexer, self).__init__(parent)
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self._queue = queue.Queue()
+        self._stopped = False
+
+    def enqueue(self, paths):
+        self._queue.put(list(paths))
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        connection = connect_library(self.path)
+        pool = None
+        while True:
+            try:
+                paths = self._queue.get(timeout=self.IDLE_TIMEOUT if pool is not None else None)
+            except queue.Empty:
+                # Workers are only kept while there is work, an idle player holds no extra processes.
+                close_pool(pool)
+                pool = None
+                continue
+            if paths is None:
+                break
+            for start in range(0, len(paths), self.CHUNK_SIZE):
+                stale = self.stale(connection, paths[start:start + self.CHUNK_SIZE])
+                if stale:
+                    pool = pool or worker_pool(self.workers)
+                    self.index(connection, pool, stale)
+                if self._stopped:
+                    break
+        close_pool(pool)
+        connection.close()
+
+    def stale(self, connection, paths):
+        stale = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            row = connection.execute('SELECT mtime, size FROM metadata WHERE path = ?', (path,)).fetchone()
+            if row != (stat.st_mtime, stat.st_size):
+                stale.append((path, stat.st_mtime, stat.st_size))
+        return stale
+
+    def index(self, connection, pool, stale):
+        records = []
+        tags = pool.map(read_tags, [path for path, mtime, size in stale])
+        for (path, mtime, size), record in zip(stale, tags):
+            record.update(path=path, mtime=mtime, size=size)
+            records.append(record)
+        connection.executemany(
+            'INSERT OR REPLACE INTO metadata VALUES '
+            '(:path, :mtime, :size, :title, :artist, :album, :album_artist, :duration)',
+            records
+        )
+        connection.commit()
+        self.indexed.emit(records)
+
+
+class CoverCache:
+    DIRECTORY = './cache/covers'
+    PLACEHOLDER_PATH = 'no-photo.png'
+    MEMORY_BUDGET = 32 * 1024 * 1024
+    WIDTH = 278
+    HEIGHT = 268
+
+    def __init__(self, directory=DIRECTORY, budget=MEMORY_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.size = 0
+        self._pixmaps = OrderedDict()
+        self._placeholder = None
+
+    @staticmethod
+    def key(track, artist=None, album=None):
+        if album:
+            source = '%s\0%s' % (artist or '', album)
+        else:
+            source = track
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def placeholder(self):
+        if self._placeholder is None:
+            pixmap = QPixmap()
+            pixmap.load(self.PLACEHOLDER_PATH)
+            self._placeholder = pixmap.scaled(self.WIDTH, self.HEIGHT, Qt.KeepAspectRatio)
+        return self._placeholder
+
+    def get(self, key):
+        entry = self._pixmaps.get(key)
+        if entry is not None:
+            self._pixmaps.move_to_end(key)
+            return entry[0]
+
+        path = os.path.join(self.directory, key + '.png')
+        if os.path.exists(path):
+            pixmap = QPixmap(path)
+            if not pixmap.isNull():
+                self._remember(key, pixmap)
+                return pixmap
+        return None
+
+    def put(self, key, image):
+        pixmap = QPixmap.fromImage(image).scaled(self.WIDTH, self.HEIGHT, Qt.KeepAspectRatio)
+        self._remember(key, pixmap)
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        pixmap.save(os.path.join(self.directory, key + '.png'), 'PNG')
+        return pixmap
+
+    def _remember(self, key, pixmap):
+        cost = pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        if key in self._pixmaps:
+            self.size -= self._pixmaps.pop(key)[1]
+        while self._pixmaps and self.size + cost > self.budget:
+            self.size -= self._pixmaps.popitem(last=False)[1][1]
+        self._pixmaps[key] = (pixmap, cost)
+        self.size += cost
+
+
+class PeakCache:
+    DIRECTORY = './cache/peaks'
+    RATE = 50
+
+    def __init__(self, directory=DIRECTORY):
+        self.directory = directory
+
+    @staticmethod
+    def key(track):
+        try:
+            stat = os.stat(track)
+        except OSError:
+            return None
+        source = '%s\0%s\0%s' % (track, stat.st_mtime, stat.st_size)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.peaks')
+
+    def get(self, key):
+        numpy = load_numpy()
+        if numpy is None or key is None:
+            return None
+        path = self.path(key)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        return numpy.memmap(path, dtype=numpy.int8, mode='r').reshape(-1, 2)
+
+    def put(self, key, peaks):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(key)
+        peaks.tofile(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+
+class PeakReducer:
+
+    def __init__(self, numpy):
+        self.numpy = numpy
+        self.window = None
+        self.rest = numpy.empty(0, dtype=numpy.float32)
+        self.chunks = []
+
+    def feed(self, samples, audio_format):
+        numpy = self.numpy
+        if self.window is None:
+            self.window = max(1, audio_format.sampleRate() * audio_format.channelCount() // PeakCache.RATE)
+        if len(self.rest):
+            samples = numpy.concatenate((self.rest, samples))
+        count = len(samples) // self.window * self.window
+        if count:
+            frames = samples[:count].reshape(-1, self.window)
+            self.chunks.append(numpy.stack((frames.min(axis=1), frames.max(axis=1)), axis=1))
+        self.rest = samples[count:]
+
+    def peaks(self):
+        numpy = self.numpy
+        if len(self.rest):
+            self.chunks.append(numpy.array([[self.rest.min(), self.rest.max()]], dtype=numpy.float32))
+            self.rest = self.rest[:0]
+        if not self.chunks:
+            return numpy.empty((0, 2), dtype=numpy.int8)
+        peaks = numpy.concatenate(self.chunks)
+        return numpy.clip(numpy.round(peaks * 127), -127, 127).astype(numpy.int8)
+
+
+class PeakAnalyzer(QThread):
+    SAMPLE_RATE = 8000
+
+    analyzed = pyqtSignal(str, str)
+
+    def __init__(self, cache, parent=None):
+        super(PeakAnalyzer, self).__init__(parent)
+        self.cache = cache
+        self._queue = queue.Queue()
+        self._stopped = False
+
+    def analyze(self, track):
+        self._queue.put(track)
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
+        self.wait()
+
+    def cancelled(self):
+        return self._stopped or not self._queue.empty()
+
+    def run(self):
+        numpy = load_numpy()
+        while not self._stopped:
+            track = self._queue.get()
+            # Only the track on screen matters, so skip requests that were overtaken.
+            while track is not None and not self._queue.empty():
+                track = self._queue.get()
+            if track is None or numpy is None:
+                continue
+            key = PeakCache.key(track)
+            if key is None:
+                continue
+            if self.cache.get(key) is None:
+                reducer = PeakReducer(numpy)
+                if not PcmDecoder(numpy, 1, self.SAMPLE_RATE).decode(track, reducer.feed, self.cancelled):
+                    continue
+                peaks = reducer.peaks()
+                if not len(peaks):
+                    continue
+                self.cache.put(key, peaks)
+            self.analyzed.emit(track, key)
+
+
+class LoudnessIndex:
+    PATH = Settings.LIBRARY_PATH
+    REFERENCE = -18.0
+    MODES = ('track', 'album')
+
+    def __init__(self, path=PATH, mode=None):
+        self.path = path
+        self.mode = mode
+        self._cache = {}
+        self._connection = connect_library(path)
+
+    def enabled(self):
+        return self.mode in self.MODES
+
+    def gain(self, path):
+        if not self.enabled():
+            return 1.0
+        if path not in self._cache:
+            self._cache[path] = self.lookup(path)
+        return self._cache[path]
+
+    def lookup(self, path):
+        row = self._connection.execute(
+            'SELECT loudness.loudness, loudness.peak, metadata.album, '
+            "COALESCE(metadata.album_artist, metadata.artist, '') "
+            'FROM loudness LEFT JOIN metadata ON metadata.path = loudness.path WHERE loudness.path = ?', (path,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return 1.0
+        loudness, peak, album, artist = row
+        if self.mode == 'album' and album:
+            # Gated block powers of the album's tracks are averaged, weighted by how many blocks passed the gates.
+            energy, blocks, album_peak = self._connection.execute(
+                'SELECT SUM(loudness.power * loudness.blocks), SUM(loudness.blocks), MAX(loudness.peak) '
+                'FROM loudness JOIN metadata ON metadata.path = loudness.path '
+                "WHERE metadata.album = ? AND COALESCE(metadata.album_artist, metadata.artist, '') = ? "
+                'AND loudness.power IS NOT NULL', (album, artist)
+            ).fetchone()
+            if blocks:
+                loudness = -0.691 + 10 * math.log10(max(energy / blocks, 1e-12))
+                peak = album_peak
+        gain = self.REFERENCE - loudness
+        if peak:
+            gain = min(gain, -20 * math.log10(peak))
+        return 10 ** (gain / 20)
+
+    def update(self, records):
+        self._cache.clear()
+
+    def close(self):
+        self._connection.close()
+
+
+class LoudnessAnalyzer(QThread):
+    CHUNK_SIZE = 8
+    IDLE_TIMEOUT = MetadataIndexer.IDLE_TIMEOUT
+
+    analyzed = pyqtSignal(list)
+
+    def __init__(self, path=LoudnessIndex.PATH, workers=None, enabled=True, parent=None):
+        super(LoudnessAnalyzer, self).__init__(parent)
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self.enabled = enabled
+        self._queue = queue.Queue()
+        self._stopped = False
+
+    def enqueue(self, paths):
+        # With replay gain off nothing is measured, so the library is not even listed.
+        if self.enabled:
+            self._queue.put(list(paths))
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        if load_numpy() is None:
+            return
+        connection = connect_library(self.path)
+        pool = None
+        while True:
+            try:
+                paths = self._queue.get(timeout=self.IDLE_TIMEOUT if pool is not None else None)
+            except queue.Empty:
+                close_pool(pool)
+                pool = None
+                continue
+            if paths is None:
+                break
+            for start in range(0, len(paths), self.CHUNK_SIZE):
+                stale = self.stale(connection, paths[start:start + self.CHUNK_SIZE])
+                if stale:
+                    pool = pool or worker_pool(self.workers)
+                    self.analyze(connection, pool, stale)
+                if self._stopped:
+                    break
+        close_pool(pool)
+        connection.close()
+
+    def stale(self, connection, paths):
+        stale = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            row = connection.execute('SELECT mtime, size FROM loudness WHERE path = ?', (path,)).fetchone()
+            if row != (stat.st_mtime, stat.st_size):
+                stale.append((path, stat.st_mtime, stat.st_size))
+        return stale
+
+    def analyze(self, connection, pool, stale):
+        records = []
+        results = pool.map(measure_loudness, [path for path, mtime, size in stale])
+        for (path, mtime, size), record in zip(stale, results):
+            record.update(path=path, mtime=mtime, size=size)
+            records.append(record)
+        connection.executemany(
+            'INSERT OR REPLACE INTO loudness VALUES (:path, :mtime, :size, :loudness, :peak, :power, :blocks)',
+            records
+        )
+        connection.commit()
+        self.analyzed.emit(records)
+
+
+class ImplicitTreap:
+
+    def __init__(self):
+        self.root = -1
+        self.left = array('i')
+        self.right = array('i')
+        self.parent = array('i')
+        self.size = array('i')
+        self.priority = array('d')
+
+    def __len__(self):
+        return self.size[self.root] if self.root >= 0 else 0
+
+    def copy(self):
+        treap = ImplicitTreap()
+        treap.root = self.root
+        for name in ('left', 'right', 'parent', 'size', 'priority'):
+            setattr(treap, name, array(getattr(self, name).typecode, getattr(self, name)))
+        return treap
+
+    def ensure(self, count):
+        missing = count - len(self.size)
+        if missing > 0:
+            self.left.extend([-1] * missing)
+            self.right.extend([-1] * missing)
+            self.parent.extend([-1] * missing)
+            self.size.extend([0] * missing)
+            self.priority.extend([random.random() for _ in range(missing)])
+
+    def build(self, nodes):
+        nodes = list(nodes)
+        self.ensure(max(nodes) + 1 if nodes else 0)
+        left, right, parent, priority = self.left, self.right, self.parent, self.priority
+        stack = []
+        for node in nodes:
+            last = -1
+            while stack and priority[stack[-1]] < priority[node]:
+                last = stack.pop()
+            left[node] = last
+            right[node] = -1
+            if last >= 0:
+                parent[last] = node
+            if stack:
+                right[stack[-1]] = node
+                parent[node] = stack[-1]
+            else:
+                parent[node] = -1
+            stack.append(node)
+        self.root = stack[0] if stack else -1
+        # Children always have lower priorities, so this order visits them before their parents.
+        size = self.size
+        for node in sorted(nodes, key=priority.__getitem__):
+            size[node] = 1 + (size[left[node]] if left[node] >= 0 else 0) + (size[right[node]] if right[node] >= 0 else 0)
+
+    def count(self, node):
+        return self.size[node] if node >= 0 else 0
+
+    def update(self, node):
+        self.size[node] = 1 + self.count(self.left[node]) + self.count(self.right[node])
+
+    def set_left(self, node, child):
+        self.left[node] = child
+        if child >= 0:
+            self.parent[child] = node
+
+    def set_right(self, node, child):
+        self.right[node] = child
+        if child >= 0:
+            self.parent[child] = node
+
+    def split(self, node, count):
+        if node < 0:
+            return -1, -1
+        if self.count(self.left[node]) >= count:
+            first, second = self.split(self.left[node], count)
+            self.set_left(node, second)
+            self.update(node)
+            return first, node
+        first, second = self.split(self.right[node], count - self.count(self.left[node]) - 1)
+        self.set_right(node, first)
+        self.update(node)
+        return node, second
+
+    def merge(self, first, second):
+        if first < 0:
+            return second
+        if second < 0:
+            return first
+        if self.priority[first] > self.priority[second]:
+            self.set_right(first, self.merge(self.right[first], second))
+            self.update(first)
+            return first
+        self.set_left(second, self.merge(first, self.left[second]))
+        self.update(second)
+        return second
+
+    def insert(self, node, position):
+        self.ensure(node + 1)
+        self.left[node] = self.right[node] = -1
+        self.size[node] = 1
+        first, second = self.split(self.root, position)
+        self.root = self.merge(self.merge(first, node), second)
+        self.parent[self.root] = -1
+
+    def remove(self, node):
+        child = self.merge(self.left[node], self.right[node])
+        parent = self.parent[node]
+        if child >= 0:
+            self.parent[child] = parent
+        if parent < 0:
+            self.root = child
+        elif self.left[parent] == node:
+            self.left[parent] = child
+        else:
+            self.right[parent] = child
+        while parent >= 0:
+            self.update(parent)
+            parent = self.parent[parent]
+        self.left[node] = self.right[node] = self.parent[node] = -1
+        self.size[node] = 0
+
+    def rank(self, node):
+        position = self.count(self.left[node])
+        while self.parent[node] >= 0:
+            parent = self.parent[node]
+            if self.right[parent] == node:
+                position += self.count(self.left[parent]) + 1
+            node = parent
+        return position
+
+    def at(self, position):
+        node = self.root
+        while node >= 0:
+            left = self.count(self.left[node])
+            if position < left:
+                node = self.left[node]
+            elif position == left:
+                return node
+            else:
+                position -= left + 1
+                node = self.right[node]
+        return -1
+
+    def nodes(self):
+        result = []
+        stack = []
+        node = self.root
+        while stack or node >= 0:
+            while node >= 0:
+                stack.append(node)
+                node = self.left[node]
+            node = stack.pop()
+            result.append(node)
+            node = self.right[node]
+        return result
+
+
+class PlaybackOrder:
+    REPEAT_OFF = 'off'
+    REPEAT_ALL = 'all'
+    REPEAT_ONE = 'one'
+    SUFFIX = '.order'
+    REBUILD_RATIO = 8
+
+    def __init__(self, playlist, shuffle=False, repeat=REPEAT_OFF, persistence=None):
+        self.playlist = playlist
+        self.repeat = repeat
+        self.persistence = persistence
+        self.shuffle = False
+        self.queue = []
+        self.sequence = None
+        self.order = None
+        self._next_node = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if shuffle:
+            self.set_shuffle(True, playlist.current_track_index, restore=True)
+
+    @property
+    def path(self):
+        return self.playlist.path + self.SUFFIX
+
+    def set_shuffle(self, shuffle, current=-1, restore=False):
+        with self._lock:
+            self.shuffle = shuffle
+            if not shuffle:
+                self.sequence = self.order = None
+                return
+            count = len(self.playlist.tracks)
+            rows = self.load_rows(count) if restore else None
+            if rows is None:
+                rows = list(range(count))
+                random.shuffle(rows)
+                if 0 <= current < count:
+                    first = rows.index(current)
+                    rows[0], rows[first] = rows[first], rows[0]
+                self._dirty = True
+            self.build(rows)
+        self.mark_dirty()
+
+    def build(self, rows):
+        # Nodes start out as row numbers; the sequence treap maps them back to rows after edits.
+        self.sequence = ImplicitTreap()
+        self.sequence.build(range(len(rows)))
+        self.order = ImplicitTreap()
+        self.order.build(rows)
+        self._next_node = len(rows)
+
+    def set_repeat(self, repeat):
+        self.repeat = repeat
+
+    def enqueue(self, rows):
+        self.queue.extend(rows)
+
+    def position(self, row):
+        if row < 0 or row >= len(self.sequence):
+            return -1
+        return self.order.rank(self.sequence.at(row))
+
+    def row_at(self, position):
+        return self.sequence.rank(self.order.at(position))
+
+    def next_row(self, current, manual=False):
+        if self.queue:
+            return self.queue[0]
+        count = len(self.playlist.tracks)
+        if not count:
+            return -1
+        if self.repeat == self.REPEAT_ONE and current >= 0 and not manual:
+            return current
+        if not self.shuffle:
+            if current + 1 < count:
+                return current + 1
+            return 0 if self.repeat != self.REPEAT_OFF else -1
+        with self._lock:
+            position = self.position(current)
+            if position + 1 < count:
+                return self.row_at(position + 1)
+            return self.row_at(0) if self.repeat != self.REPEAT_OFF else -1
+
+    def prev_row(self, current):
+        count = len(self.playlist.tracks)
+        if not count or current < 0:
+            return -1
+        if not self.shuffle:
+            if current > 0:
+                return current - 1
+            return count - 1 if self.repeat != self.REPEAT_OFF else -1
+        with self._lock:
+            position = self.position(current)
+            if position > 0:
+                return self.row_at(position - 1)
+            return self.row_at(count - 1) if self.repeat != self.REPEAT_OFF else -1
+
+    def played(self, row):
+        if row in self.queue:
+            self.queue.remove(row)
+
+    def inserted(self, row, count, current=-1):
+        self.queue = [queued + count if queued >= row else queued for queued in self.queue]
+        if not self.shuffle:
+            return
+        with self._lock:
+            # New tracks land somewhere in the part of the shuffle that has not been played yet.
+            played = self.position(current)
+            for offset in range(count):
+                node = self._next_node
+                self._next_node += 1
+                self.sequence.insert(node, row + offset)
+                self.order.insert(node, random.randint(played + 1, len(self.order)))
+            self._dirty = True
+        self.mark_dirty()
+
+    def removed(self, ranges):
+        self.queue = [row for row in map(ranges.removed_row, self.queue) if row >= 0]
+        if not self.shuffle:
+            return
+        with self._lock:
+            if ranges.count * self.REBUILD_RATIO > len(self.sequence):
+                nodes = self.sequence.nodes()
+                removed = {nodes[row] for row in ranges.rows()}
+                self.sequence.build(node for node in nodes if node not in removed)
+                self.order.build([node for node in self.order.nodes() if node not in removed])
+            else:
+                for node in [self.sequence.at(row) for row in ranges.rows()]:
+                    self.sequence.remove(node)
+                    self.order.remove(node)
+            self._dirty = True
+        self.mark_dirty()
+
+    def moved(self, ranges, target):
+        self.queue = [ranges.moved_row(row, target) for row in self.queue]
+        if not self.shuffle:
+            return
+        with self._lock:
+            # Only the sequence changes, the moved tracks keep their place in the shuffle.
+            if ranges.count * self.REBUILD_RATIO > len(self.sequence):
+                self.sequence.build(ranges.move_in(self.sequence.nodes(), target))
+            else:
+                nodes = [self.sequence.at(row) for row in ranges.rows()]
+                for node in nodes:
+                    self.sequence.remove(node)
+                position = ranges.position(target)
+                for offset, node in enumerate(nodes):
+                    self.sequence.insert(node, position + offset)
+            self._dirty = True
+        self.mark_dirty()
+
+    def rows(self, sequence=None, order=None):
+        sequence = sequence or self.sequence
+        order = order or self.order
+        row_of = {node: row for row, node in enumerate(sequence.nodes())}
+        return [row_of[node] for node in order.nodes()]
+
+    def load_rows(self, count):
+        if not os.path.exists(self.path):
+            return None
+        rows = array('I')
+        with open(self.path, 'rb') as f:
+            rows.frombytes(f.read())
+        if len(rows) != count or len(set(rows)) != count or (count and max(rows) >= count):
+            return None
+        return list(rows)
+
+    def mark_dirty(self):
+        if not self._dirty:
+            return
+        if self.persistence is not None:
+            self.persistence.mark_dirty(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        # Held across the write, so a caller returns only after a flush already in progress is done too.
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty or not self.shuffle:
+                    return
+                self._dirty = False
+                # Walking 100k nodes takes a while, so only the copies are taken under the lock.
+                sequence, order = self.sequence.copy(), self.order.copy()
+            atomic_write(self.path, array('I', self.rows(sequence, order)).tobytes())
 
 
 class MediaPlayer:
@@ -143,115 +2494,906 @@ class MediaPlayer:
         '.wav',
         '.mp4',
     ]
+    PREBUFFER_TIME = 5000
+    FADE_INTERVAL = 50
+
+    def __init__(self, playlist, persistence=None, metadata=None, crossfade=0, loudness=None, searchable=True) -> None:
+        self.persistence = persistence
+        self.crossfade = crossfade
+        self.loudness = loudness
+        self.shuffle = False
+        self.repeat = PlaybackOrder.REPEAT_OFF
+        self.playlist_events = PlaylistEvents()
 
-    def __init__(self, playlist) -> None:
-        self.__media_player = QMediaPlayer()
-        self.__media_playlist = QMediaPlaylist()
-
-        self.__media_player.setPlaylist(self.__media_playlist)
-
-        self.__playlist_model = PlaylistModel(self.__media_playlist)
+        self.__players = [QMediaPlayer(), QMediaPlayer()]
+        self.__active = 0
+        self.__volume = 100
+        self.__gains = [1.0, 1.0]
+        self.__preloaded_index = -1
+        self.__fading_player = None
+        self.__fade_started = 0
+        self.__fade_timer = QTimer()
+        self.__fade_timer.setInterval(self.FADE_INTERVAL)
+        self.__fade_timer.timeout.connect(self.fade_step)
+        for player in self.__players:
+            player.mediaStatusChanged.connect(partial(self.media_status_changed, player))
+            player.positionChanged.connect(partial(self.player_position_changed, player))
+            player.durationChanged.connect(partial(self.relay, player, self.playlist_events.duration_changed))
+            player.metaDataChanged.connect(partial(self.relay, player, self.playlist_events.metadata_changed))
+
+        self.__playlist_path = playlist
+        self.__playlist = None
+        self.__playlist_loader = None
+        self.__playlist_model = PlaylistModel(None, metadata, searchable)
+        self.__playlist_cache = PlaylistCache()
+        self.__journal_writers = {}
+        self.__order = None
+        self.__current_index = -1
+
+
+    @property
+    def active_player(self):
+        return self.__players[self.__active]
+
+    @property
+    def standby_player(self):
+        return self.__players[1 - self.__active]
+
+    def restore(self):
+        self.__playlist_loader = PlaylistLoader(self.__playlist_path, self.persistence)
+        self.__playlist_loader.loaded.connect(self.restored)
+        self.__playlist_loader.start()
+
+    def restored(self, playlist):
+        self.__playlist_loader.wait()
+        self.__playlist_loader = None
+        self.playlist_events.playlist_loaded.emit(playlist)
+        # A playlist created or opened while restoring wins over the restored one.
+        if self.__playlist is None:
+            self.change_playlist(playlist)
+
+    def load(self, search_index=None):
+        self.stop()
+        self.__current_index = -1
+        self.__preloaded_index = -1
+        self.__order = PlaybackOrder(self.__playlist, self.shuffle, self.repeat, self.persistence)
+        index = self.__playlist.current_track_index
+        if not 0 <= index < len(self.__playlist.tracks):
+            index = 0 if self.__playlist.tracks else -1
+        self.load_track(index, False)
+        self.__playlist_model.set_playlist(self.__playlist, search_index)
+        self.playlist_events.playlist_changed.emit(self.__playlist)
 
-        self.__playlist = Playlist(path=playlist)
-        self.__media_playlist.currentIndexChanged.connect(self.update_playlist_index)
-        self.playlist_events = PlaylistEvents()
+    def load_track(self, index, play):
+        self.finish_fade()
+        if play and index >= 0 and index == self.__preloaded_index:
+            self.switch(index, False)
+            return
+
+        if self.__playlist is None:
+            return
+        player = self.active_player
+        player.stop()
+        if 0 <= index < len(self.__playlist.tracks):
+            player.setMedia(self.media_content(self.__playlist.tracks[index]))
+            self.set_gain(player, self.__playlist.tracks[index])
+            player.setVolume(self.player_volume(player))
+        else:
+            player.setMedia(QMediaContent())
+        self.set_current(index)
+        if play and index >= 0:
+            player.play()
+
+    def switch(self, index, fade):
+        previous = self.active_player
+        self.__active = 1 - self.__active
+        player = self.active_player
+        self.__preloaded_index = -1
+
+        player.setVolume(0 if fade else self.player_volume(player))
+        player.play()
+        if fade:
+            self.__fading_player = previous
+            self.__fade_started = time.perf_counter()
+            self.__fade_timer.start()
+        else:
+            previous.stop()
+
+        self.set_current(index)
+        self.playlist_events.duration_changed.emit(player.duration())
+        self.playlist_events.metadata_changed.emit()
+
+    def fade_step(self):
+        progress = (time.perf_counter() - self.__fade_started) * 1000 / max(self.crossfade, 1)
+        if progress >= 1 or self.__fading_player is None:
+            self.finish_fade()
+            return
+        self.active_player.setVolume(self.player_volume(self.active_player, progress))
+        self.__fading_player.setVolume(self.player_volume(self.__fading_player, 1 - progress))
+
+    def finish_fade(self):
+        self.__fade_timer.stop()
+        if self.__fading_player is not None:
+            self.__fading_player.stop()
+            self.__fading_player = None
+        self.active_player.setVolume(self.player_volume(self.active_player))
+
+    def preload(self, index):
+        if index == self.__preloaded_index:
+            return
+        player = self.standby_player
+        player.setVolume(0)
+        player.setMedia(self.media_content(self.__playlist.tracks[index]))
+        self.set_gain(player, self.__playlist.tracks[index])
+        player.pause()
+        self.__preloaded_index = index
+
+    def set_gain(self, player, track):
+        gain = self.loudness.gain(track) if self.loudness is not None else 1.0
+        self.__gains[self.__players.index(player)] = gain
+
+    def refresh_gain(self):
+        track = self.current_track()
+        if track is None:
+            return
+        self.set_gain(self.active_player, track)
+        if self.__fading_player is None:
+            self.active_player.setVolume(self.player_volume(self.active_player))
+        if self.__preloaded_index >= 0:
+            self.set_gain(self.standby_player, self.__playlist.tracks[self.__preloaded_index])
+
+    def player_volume(self, player, scale=1.0):
+        gain = self.__gains[self.__players.index(player)]
+        return min(100, int(round(self.__volume * gain * scale)))
+
+    def next_index(self, manual=False):
+        if self.__order is None:
+            return -1
+        return self.__order.next_row(self.__current_index, manual)
+
+    def set_shuffle(self, shuffle):
+        self.shuffle = shuffle
+        if self.__order is not None:
+            self.__order.set_shuffle(shuffle, self.__current_index)
+        self.__preloaded_index = -1
+
+    def set_repeat(self, repeat):
+        self.repeat = repeat
+        if self.__order is not None:
+            self.__order.set_repeat(repeat)
+        self.__preloaded_index = -1
+
+    def enqueue(self, rows):
+        if self.__order is None:
+            return
+        self.__order.enqueue(row for row in rows if 0 <= row < len(self.__playlist.tracks))
+        self.__preloaded_index = -1
+
+    def media_content(self, track):
+        return QMediaContent(QUrl.fromLocalFile(track))
+
+    def relay(self, player, signal, *args):
+        if player is self.active_player:
+            signal.emit(*args)
+
+    def player_position_changed(self, player, position):
+        if player is not self.active_player:
+            return
+        self.playlist_events.position_changed.emit(position)
+
+        duration = player.duration()
+        index = self.next_index()
+        if duration <= 0 or index < 0 or self.__fading_player is not None:
+            return
+        remaining = duration - position
+        if remaining <= self.PREBUFFER_TIME + self.crossfade:
+            self.preload(index)
+        if self.crossfade > 0 and remaining <= self.crossfade and player.state() == QMediaPlayer.PlayingState:
+            self.switch(index, True)
+
+    def media_status_changed(self, player, status):
+        if player is not self.active_player or status != QMediaPlayer.EndOfMedia:
+            return
+        index = self.next_index()
+        if index < 0:
+            self.set_current(-1)
+        else:
+            self.load_track(index, True)
 
+    def set_current(self, index):
+        if index >= 0:
+            self.__order.played(index)
+        self.update_current(index)
 
-    def load(self):
-        self.__media_player.stop()
-        self.__media_playlist.clear()
-        for track in self.__playlist.tracks:
-            url = QUrl.fromLocalFile(track)
-            self.__media_playlist.addMedia(QMediaContent(url))
-        self.__media_playlist.setCurrentIndex(self.__playlist.current_track_index)
-        self.__playlist_model.layoutChanged.emit()
-        self.playlist_events.playlist_changed.emit(self.__playlist)
+    def update_current(self, index):
+        if index == self.__current_index:
+            return
+        self.__current_index = index
+        self.__playlist.set_current_track_index(index)
+        self.playlist_events.current_index_changed.emit(index)
 
     def create_playlist(self, name):
-        playlist = Playlist(name=name)
-        self.change_playlist(playlist)
+        if self.is_current_playlist(Playlist.BASE_PATH % name):
+            return
+        playlist, search_index = self.open_playlist(Playlist.BASE_PATH % name)
+        if playlist is None:
+            playlist = Playlist(name=name, persistence=self.persistence)
+        self.change_playlist(playlist, search_index)
 
     def load_playlist(self, path):
-        playlist = Playlist(path=path)
-        self.change_playlist(playlist)
-
-    def change_playlist(self, playlist):
+        if self.is_current_playlist(path):
+            return
+        playlist, search_index = self.open_playlist(path)
+        if playlist is None:
+            playlist = Playlist(path=path, persistence=self.persistence)
+        self.change_playlist(playlist, search_index)
+
+    def is_current_playlist(self, path):
+        # The open playlist may have journal ops that are not on disk yet, so it is never read again.
+        return self.__playlist is not None and os.path.abspath(path) == os.path.abspath(self.__playlist.path)
+
+    def open_playlist(self, path):
+        playlist, search_index = self.__playlist_cache.take(path)
+        if playlist is None:
+            self.flush_pending()
+        return playlist, search_index
+
+    def flush_pending(self):
+        # A playlist dropped from the cache can still be waiting in the persistence queue.
+        if self.persistence is not None:
+            self.persistence.flush()
+
+    def change_playlist(self, playlist, search_index=None):
+        if self.__playlist is not None and self.__playlist is not playlist:
+            self.__playlist_cache.put(self.__playlist, self.__playlist_model.search_index)
+        if self.__order is not None:
+            # Orders are read back from disk, so a playlist coming back from the cache must find this one written.
+            self.__order.flush()
         self.__playlist = playlist
-        self.load()
+        self.load(search_index)
 
     def get_model(self):
         return self.__playlist_model
 
+    def tracks(self):
+        if self.__playlist is None:
+            return []
+        return list(self.__playlist.tracks)
+
+    def track_list(self):
+        if self.__playlist is None:
+            return TrackList(TrackStore())
+        return self.__playlist.tracks
+
+    def current_track(self):
+        if self.__playlist is not None and 0 <= self.__current_index < len(self.__playlist.tracks):
+            return self.__playlist.tracks[self.__current_index]
+        return None
+
     def isMetaDataAvailable(self):
-        return self.__media_player.isMetaDataAvailable()
+        return self.active_player.isMetaDataAvailable()
 
     def metaData(self, key):
-        return self.__media_player.metaData(key)
+        return self.active_player.metaData(key)
 
-    def set_current_index(self, index):
-        self.__media_playlist.setCurrentIndex(index)
+    def is_playing(self):
+        return self.active_player.state() == QMediaPlayer.PlayingState
 
-    def update_playlist_index(self, index):
-        self.__playlist.set_current_track_index(index)
+    def state(self):
+        return self.active_player.state()
+
+    def position(self):
+        return self.active_player.position()
+
+    def duration(self):
+        return self.active_player.duration()
+
+    def current_index(self):
+        return self.__current_index
+
+    def current_playlist(self):
+        return self.__playlist
+
+    def set_current_index(self, index):
+        self.load_track(index, False)
 
     def play(self):
-        self.__media_player.play()
+        if self.__current_index < 0 and self.__playlist is not None and self.__playlist.tracks:
+            self.load_track(0, False)
+        self.active_player.play()
 
     def pause(self):
-        self.__media_player.pause()
+        self.finish_fade()
+        self.active_player.pause()
 
     def stop(self):
-        self.__media_player.stop()
+        self.finish_fade()
+        for player in self.__players:
+            player.stop()
 
     def next(self):
-        self.__media_playlist.next()
+        index = self.next_index(manual=True)
+        if index >= 0:
+            self.load_track(index, self.is_playing())
 
     def prev(self):
-        self.__media_playlist.previous()
+        if self.__order is None:
+            return
+        index = self.__order.prev_row(self.__current_index)
+        if index >= 0:
+            self.load_track(index, self.is_playing())
 
     def remove_media(self, index):
-        self.__media_playlist.removeMedia(index)
-        self.__playlist.remove_item(index)
+        self.remove_ranges(RowRanges([(index, index + 1)]))
+
+    def remove_rows(self, rows):
+        if self.__playlist is None:
+            return
+        ranges = RowRanges.from_rows(row for row in rows if 0 <= row < len(self.__playlist.tracks))
+        if ranges.count:
+            self.remove_ranges(ranges)
+
+    def remove_ranges(self, ranges):
+        if self.__playlist is None:
+            return
+        self.__playlist.remove_ranges(ranges)
+        self.__playlist_model.tracks_removed(ranges)
+        self.__order.removed(ranges)
+
+        if self.__preloaded_index >= 0:
+            self.__preloaded_index = ranges.removed_row(self.__preloaded_index)
+
+        current = self.__current_index
+        if current in ranges:
+            index = min(ranges.position(current), len(self.__playlist.tracks) - 1)
+            if index >= 0:
+                # Another track now sits in that row, so loading it must not be skipped as unchanged.
+                self.__current_index = -1
+            self.load_track(index, self.is_playing())
+        elif current >= 0:
+            self.update_current(ranges.removed_row(current))
+
+    def move_rows(self, rows, target):
+        if self.__playlist is None:
+            return
+        count = len(self.__playlist.tracks)
+        ranges = RowRanges.from_rows(row for row in rows if 0 <= row < count)
+        target = max(0, min(target, count))
+        if not ranges.count or len(ranges.ranges) == 1 and ranges.ranges[0][0] <= target <= ranges.ranges[0][1]:
+            return
+        self.__playlist.move_ranges(ranges, target)
+        self.__playlist_model.tracks_moved(ranges, target)
+        self.__order.moved(ranges, target)
+        self.__preloaded_index = -1
+        if self.__current_index >= 0:
+            self.update_current(ranges.moved_row(self.__current_index, target))
 
     def add_media(self, file):
-        extension = os.path.splitext(file)[1]
-        if extension not in self.SUPPORTED_FORMATS:
-            return False
-        url = QUrl.fromLocalFile(file)
-        self.__media_playlist.addMedia(QMediaContent(url))
-        self.__playlist_model.layoutChanged.emit()
-        self.__playlist.add_item(file)
-        return True
+        return self.add_media_batch([file]) == 1
+
+    def replace_media(self, index, file):
+        if self.__playlist is None:
+            return
+        old = self.__playlist.tracks[index]
+        self.__playlist.replace_item(index, file)
+        self.__playlist_model.track_replaced(index, old)
+        if index == self.__preloaded_index:
+            self.__preloaded_index = -1
+
+    def apply_folder_changes(self, playlist_path, added, removed, moved):
+        if not self.is_current_playlist(playlist_path):
+            playlist = self.__playlist_cache.peek(playlist_path)
+            if playlist is not None:
+                self.__playlist_cache.invalidate_index(playlist_path)
+                return playlist.apply_folder_changes(added, removed, moved)
+            # A playlist that is not loaded only gets the changes appended to its journal, in the background.
+            key = os.path.abspath(playlist_path)
+            if key not in self.__journal_writers:
+                self.__journal_writers[key] = JournalWriter(playlist_path, self.persistence)
+            self.__journal_writers[key].append(
+                {'op': 'folder_changes', 'added': list(added), 'removed': list(removed), 'moved': list(moved)}
+            )
+            return list(added)
+
+        rows_of = self.__playlist_model.rows_of
+        for source, target in moved:
+            rows = rows_of([source])
+            if rows and not rows_of([target]):
+                self.replace_media(rows[-1], target)
+        added = [path for path in added if not rows_of([path])]
+        ranges = RowRanges.from_rows(rows_of(removed))
+        if ranges.count:
+            self.remove_ranges(ranges)
+        if added:
+            self.add_media_batch(added)
+        return added
+
+    def add_media_batch(self, files):
+        files = [file for file in files if os.path.splitext(file)[1].lower() in self.SUPPORTED_FORMATS]
+        if not files or self.__playlist is None:
+            return 0
+        first = len(self.__playlist.tracks)
+        self.__playlist.add_items(files)
+        self.__playlist_model.tracks_appended(len(files))
+        self.__order.inserted(first, len(files), self.__current_index)
+        return len(files)
 
     def duration_changed_connect(self, function):
-        return self.__media_player.durationChanged.connect(function)
+        return self.playlist_events.duration_changed.connect(function)
 
     def position_changed_connect(self, function):
-        return self.__media_player.positionChanged.connect(function)
+        return self.playlist_events.position_changed.connect(function)
 
     def metadata_changed_connect(self, function):
-        return self.__media_player.metaDataChanged.connect(function)
+        return self.playlist_events.metadata_changed.connect(function)
 
     def current_index_changed_connect(self, function):
-        self.__media_playlist.currentIndexChanged.connect(function)
+        self.playlist_events.current_index_changed.connect(function)
+
+    def set_notify_interval(self, interval):
+        for player in self.__players:
+            player.setNotifyInterval(interval)
+
+    def set_volume(self, volume):
+        self.__volume = volume
+        if self.__fading_player is None:
+            self.active_player.setVolume(self.player_volume(self.active_player))
+
+    def set_position(self, position):
+        self.active_player.setPosition(position)
 
     def connect_volume_slider(self, volume_slider):
-        volume_slider.valueChanged.connect(self.__media_player.setVolume)
+        self.set_volume(volume_slider.value())
+        volume_slider.valueChanged.connect(self.set_volume)
 
     def connect_time_slider(self, time_slider):
-        time_slider.valueChanged.connect(self.__media_player.setPosition)
+        time_slider.valueChanged.connect(self.set_position)
+
+
+class HeadlessPlayer(QObject):
+    STATES = {
+        QMediaPlayer.StoppedState: 'stopped',
+        QMediaPlayer.PlayingState: 'playing',
+        QMediaPlayer.PausedState: 'paused',
+    }
+    MAX_REQUEST_SIZE = 64 * 1024
+    SIGNAL_INTERVAL = 500
+    WORKERS = 2
+
+    def __init__(self, profile=None, parent=None):
+        super(HeadlessPlayer, self).__init__(parent)
+        self.profile = profile or StartupProfile(time.perf_counter())
+        self.settings = Settings()
+        self.persistence = PersistenceService(self.settings.flush_interval)
+        self.settings.persistence = self.persistence
+        self.metadata_index = MetadataIndex()
+        self.metadata_indexer = MetadataIndexer(self.metadata_index.path, self.WORKERS, parent=self)
+        self.loudness_index = LoudnessIndex(mode=self.settings.replay_gain)
+        self.loudness_analyzer = LoudnessAnalyzer(
+            self.loudness_index.path, self.WORKERS, enabled=self.loudness_index.enabled(), parent=self
+        )
+        # Nothing searches the playlist without a window, so the search index is never built.
+        self.media_player = MediaPlayer(
+            self.settings.opened_playlist, self.persistence, self.metadata_index, self.settings.crossfade,
+            self.loudness_index, searchable=False
+        )
+        self.media_player.shuffle = self.settings.shuffle
+        self.media_player.repeat = self.settings.repeat
+        self.media_player.set_notify_interval(self.settings.notify_interval)
+        self.media_player.playlist_events.playlist_changed.connect(self.playlist_changed)
+        self.metadata_indexer.indexed.connect(self.metadata_index.update)
+        self.loudness_analyzer.analyzed.connect(self.loudness_analyzed)
+
+        self.commands = {
+            'play': self.play,
+            'pause': self.pause,
+            'next': self.next,
+            'load': self.load,
+            'add_folder': self.add_folder,
+            'status': self.status,
+        }
+        # Only the headless player listens on a socket, so the window never loads QtNetwork.
+        from PyQt5.QtNetwork import QLocalServer
+        self.server = QLocalServer(self)
+        self.server.newConnection.connect(self.accept)
+        self._folder_scanner = None
+        self._scan_playlist = None
+        self._folders = []
+
+        # Python only runs signal handlers between bytecodes, so the event loop is woken up now and then.
+        self._signal_timer = QTimer(self)
+        self._signal_timer.timeout.connect(lambda: None)
+        self.profile.mark('backend')
+
+    def start(self, report=False):
+        path = os.path.abspath(self.settings.control_socket)
+        self.server.removeServer(path)
+        if not self.server.listen(path):
+            sys.stderr.write('Cannot listen on %s: %s\n' % (path, self.server.errorString()))
+            return False
+        self.profile.mark('control socket')
+
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_number, lambda *args: QCoreApplication.quit())
+        self._signal_timer.start(self.SIGNAL_INTERVAL)
+        QCoreApplication.instance().aboutToQuit.connect(self.stop)
+
+        self.metadata_indexer.start()
+        if self.loudness_analyzer.enabled:
+            self.loudness_analyzer.start()
+        self._report_startup = report
+        self.media_player.playlist_events.playlist_changed.connect(self.playlist_restored)
+        self.media_player.restore()
+        return True
+
+    def stop(self):
+        self.server.close()
+        self.cancel_scan()
+        self.metadata_indexer.stop()
+        self.loudness_analyzer.stop()
+        self.metadata_index.close()
+        self.loudness_index.close()
+        self.persistence.close()
+
+    def playlist_restored(self, playlist):
+        self.media_player.playlist_events.playlist_changed.disconnect(self.playlist_restored)
+        self.profile.mark('Playlist.load')
+        if self._report_startup:
+            self.profile.report()
+            QCoreApplication.quit()
+
+    def playlist_changed(self, playlist):
+        self.settings.set_opened_playlist(playlist.path)
+        self.metadata_indexer.enqueue(playlist.tracks)
+        self.loudness_analyzer.enqueue(playlist.tracks)
+        # A folder being scanned belongs to the playlist it was added to.
+        if self._folder_scanner is not None and playlist is not self._scan_playlist:
+            self.cancel_scan()
+        # Folders added before the saved playlist was restored are waiting for one.
+        if self._folder_scanner is None and self._folders:
+            self.scan_next()
+
+    def loudness_analyzed(self, records):
+        self.loudness_index.update(records)
+        if self.media_player.current_track() in [record['path'] for record in records]:
+            self.media_player.refresh_gain()
+
+    def accept(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            connection.readyRead.connect(partial(self.read, connection))
+            connection.disconnected.connect(connection.deleteLater)
+
+    def read(self, connection):
+        while connection.canReadLine():
+            line = bytes(connection.readLine()).strip()
+            if line:
+                connection.write(json.dumps(self.handle(line)).encode('utf-8') + b'\n')
+        if connection.bytesAvailable() > self.MAX_REQUEST_SIZE:
+            connection.abort()
+
+    def handle(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            command = self.commands[request['command']]
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': 'expected {"command": one of %s}' % ', '.join(sorted(self.commands))}
+        try:
+            result = command(request)
+        except (KeyError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': 'bad argument: %s' % e}
+        if isinstance(result, str):
+            return {'ok': False, 'error': result}
+        return dict(result or {}, ok=True)
+
+    def play(self, request):
+        self.media_player.play()
+
+    def pause(self, request):
+        self.media_player.pause()
+
+    def next(self, request):
+        self.media_player.next()
+
+    def load(self, request):
+        path = request['playlist']
+        if not os.path.isfile(path):
+            return 'no such playlist: %s' % path
+        self.media_player.load_playlist(path)
+
+    def add_folder(self, request):
+        folder = os.path.abspath(request['folder'])
+        if not os.path.isdir(folder):
+            return 'no such folder: %s' % folder
+        self._folders.append(folder)
+        if self._folder_scanner is None:
+            self.scan_next()
+
+    def status(self, request):
+        playlist = self.media_player.current_playlist()
+        track = self.media_player.current_track()
+        return {
+            'state': self.STATES.get(self.media_player.state(), 'stopped'),
+            'track': track,
+            'title': self.media_player.get_model().title(track) if track is not None else None,
+            'index': self.media_player.current_index(),
+            'position': self.media_player.position(),
+            'duration': self.media_player.duration(),
+            'playlist': playlist.path if playlist is not None else None,
+            'name': playlist.name if playlist is not None else None,
+            'tracks': len(playlist.tracks) if playlist is not None else 0,
+            'shuffle': self.media_player.shuffle,
+            'repeat': self.media_player.repeat,
+            'scanning': ([self._folder_scanner.folder] if self._folder_scanner is not None else []) + self._folders,
+        }
+
+    def scan_next(self):
+        if self._folder_scanner is not None:
+            self._folder_scanner.deleteLater()
+            self._folder_scanner = None
+        if not self._folders or self.media_player.current_playlist() is None:
+            return
+        self._scan_playlist = self.media_player.current_playlist()
+        self._folder_scanner = FolderScanner(
+            self._folders.pop(0), MediaPlayer.SUPPORTED_FORMATS, self.media_player.track_list(), workers=self.WORKERS,
+            parent=self
+        )
+        self._folder_scanner.chunk_found.connect(self.scan_chunk)
+        self._folder_scanner.finished.connect(self.scan_next)
+        self._folder_scanner.start()
+
+    def scan_chunk(self, files):
+        if self._folder_scanner is None or self._folder_scanner.is_cancelled():
+            return
+        self.media_player.add_media_batch(files)
+        self.metadata_indexer.enqueue(files)
+        self.loudness_analyzer.enqueue(files)
+
+    def cancel_scan(self):
+        self._folders = []
+        if self._folder_scanner is not None:
+            self._folder_scanner.finished.disconnect(self.scan_next)
+            self._folder_scanner.cancel()
+            self._folder_scanner.wait()
+            self._folder_scanner = None
+
+
+class PlaylistView(QtWidgets.QListView):
+
+    rows_dropped = pyqtSignal(list, int)
+
+    def __init__(self, parent=None):
+        super(PlaylistView, self).__init__(parent)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.setDragDropMode(QtWidgets.QAbstractItemView.InternalMove)
+        self.setDefaultDropAction(Qt.MoveAction)
+
+    def selected_rows(self):
+        return [
+            row for selection_range in self.selectionModel().selection()
+            for row in range(selection_range.top(), selection_range.bottom() + 1)
+        ]
+
+    def dropEvent(self, event):
+        if event.source() is not self:
+            super(PlaylistView, self).dropEvent(event)
+            return
+        index = self.indexAt(event.pos())
+        position = self.dropIndicatorPosition()
+        if not index.isValid() or position == QtWidgets.QAbstractItemView.OnViewport:
+            target = self.model().rowCount()
+        elif position == QtWidgets.QAbstractItemView.BelowItem:
+            target = index.row() + 1
+        else:
+            target = index.row()
+        rows = self.selected_rows()
+        # The model refuses row moves and drops, so the base class only resets the drag state here.
+        super(PlaylistView, self).dropEvent(event)
+        self.rows_dropped.emit(rows, target)
+
+
+class WaveformSlider(QtWidgets.QSlider):
+    MINIMUM_HEIGHT = 28
+
+    def __init__(self, parent=None):
+        super(WaveformSlider, self).__init__(Qt.Horizontal, parent)
+        self.setMinimumHeight(self.MINIMUM_HEIGHT)
+        self.peaks = None
+        self._lines = None
+
+    def set_peaks(self, peaks):
+        self.peaks = peaks
+        self._lines = None
+        self.update()
+
+    def resizeEvent(self, event):
+        self._lines = None
+        super(WaveformSlider, self).resizeEvent(event)
+
+    def lines(self):
+        numpy = load_numpy()
+        width, height = self.width(), self.height()
+        count = len(self.peaks)
+        if not width or not count:
+            return []
+        edges = numpy.linspace(0, count, min(width, count) + 1).astype(numpy.int64)[:-1]
+        columns = numpy.stack((
+            numpy.minimum.reduceat(self.peaks[:, 0], edges),
+            numpy.maximum.reduceat(self.peaks[:, 1], edges),
+        ), axis=1).astype(numpy.float32) / 127
+        middle = height / 2
+        step = width / len(columns)
+        return [
+            QLineF(i * step, middle - high * middle, i * step, middle - low * middle + 1)
+            for i, (low, high) in enumerate(columns.tolist())
+        ]
+
+    def paintEvent(self, event):
+        if self.peaks is None:
+            super(WaveformSlider, self).paintEvent(event)
+            return
+        if self._lines is None:
+            self._lines = self.lines()
+
+        played = QtWidgets.QStyle.sliderPositionFromValue(self.minimum(), self.maximum(), self.value(), self.width())
+        split = bisect_left([line.x1() for line in self._lines], played) if self._lines else 0
+        painter = QPainter(self)
+        painter.setPen(self.palette().highlight().color())
+        painter.drawLines(self._lines[:split])
+        painter.setPen(self.palette().mid().color())
+        painter.drawLines(self._lines[split:])
+        painter.setPen(self.palette().text().color())
+        painter.drawLine(played, 0, played, self.height())
+
+    def mousePressEvent(self, event):
+        if self.peaks is None or event.button() != Qt.LeftButton:
+            super(WaveformSlider, self).mousePressEvent(event)
+            return
+        self.setSliderDown(True)
+        self.seek(event.x())
+
+    def mouseMoveEvent(self, event):
+        if self.peaks is None or not self.isSliderDown():
+            super(WaveformSlider, self).mouseMoveEvent(event)
+            return
+        self.seek(event.x())
+
+    def mouseReleaseEvent(self, event):
+        if self.peaks is None or not self.isSliderDown():
+            super(WaveformSlider, self).mouseReleaseEvent(event)
+            return
+        self.setSliderDown(False)
+
+    def seek(self, x):
+        self.setValue(QtWidgets.QStyle.sliderValueFromPosition(self.minimum(), self.maximum(), x, self.width()))
+
+
+class InstrumentationDialog(QtWidgets.QDialog):
+    COLUMNS = ['Call', 'Count', 'Total ms', 'Mean ms', 'p50 ms', 'p95 ms', 'Max ms']
+    REFRESH_INTERVAL = 1000
+
+    def __init__(self, instrumentation, parent=None):
+        super(InstrumentationDialog, self).__init__(parent)
+        self.instrumentation = instrumentation
+        self.setWindowTitle('Performance')
+        self.resize(640, 400)
+
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+        self.stalls_label = QtWidgets.QLabel(self)
+
+        reset_button = QtWidgets.QPushButton('Reset', self)
+        reset_button.clicked.connect(self.reset)
+        json_button = QtWidgets.QPushButton('Export JSON', self)
+        json_button.clicked.connect(self.export_json)
+        trace_button = QtWidgets.QPushButton('Export trace', self)
+        trace_button.clicked.connect(self.export_trace)
+
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(self.stalls_label)
+        buttons.addStretch()
+        buttons.addWidget(reset_button)
+        buttons.addWidget(json_button)
+        buttons.addWidget(trace_button)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.setInterval(self.REFRESH_INTERVAL)
+        self._refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self._refresh_timer.start()
+        super(InstrumentationDialog, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self._refresh_timer.stop()
+        super(InstrumentationDialog, self).hideEvent(event)
+
+    def refresh(self):
+        rows, stalls = self.instrumentation.summary()
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            values = [row['name'], str(row['count'])]
+            values += ['%.2f' % row[key] for key in ('total', 'mean', 'p50', 'p95', 'max')]
+            for column, value in enumerate(values):
+                self.table.setItem(i, column, QtWidgets.QTableWidgetItem(value))
+        longest = max([stall['duration'] for stall in stalls] or [0])
+        self.stalls_label.setText('Stalls over %d ms: %d (longest %.0f ms)' % (
+            self.instrumentation.stall_threshold, len(stalls), longest
+        ))
+
+    def reset(self):
+        self.instrumentation.reset()
+        self.refresh()
+
+    def export_json(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Export JSON', 'instrumentation.json', 'JSON (*.json)')
+        if path:
+            self.instrumentation.export(path)
+
+    def export_trace(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Export Chrome trace', 'instrumentation.trace.json', 'Chrome trace (*.json)'
+        )
+        if path:
+            self.instrumentation.export(path, trace=True)
 
 
 class Application(QtWidgets.QMainWindow):
 
-    def __init__(self):
+    def __init__(self, profile=None, instrumentation=None):
         super(Application, self).__init__()
+        self.profile = profile or StartupProfile(time.perf_counter())
+        self.instrumentation = instrumentation
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
+        self.profile.mark('setupUi')
 
         self.settings = Settings()
-        self._media_player = MediaPlayer(self.settings.opened_playlist)
+        self.profile.mark('Settings')
+        self.persistence = PersistenceService(self.settings.flush_interval)
+        self.settings.persistence = self.persistence
+        self.metadata_index = MetadataIndex()
+        self.cover_cache = CoverCache()
+        self.peak_cache = PeakCache()
+        self.peak_analyzer = PeakAnalyzer(self.peak_cache, self)
+        self.metadata_indexer = MetadataIndexer(self.metadata_index.path, parent=self)
+        self.loudness_index = LoudnessIndex(mode=self.settings.replay_gain)
+        self.loudness_analyzer = LoudnessAnalyzer(
+            self.loudness_index.path, enabled=self.loudness_index.enabled(), parent=self
+        )
+        self.folder_watcher = FolderWatcher(MediaPlayer.SUPPORTED_FORMATS, parent=self)
+        self.file_watcher = QFileSystemWatcher(self)
+        self._changed_directories = set()
+        self._rescan_timer = QTimer(self)
+        self._rescan_timer.setSingleShot(True)
+        self._rescan_timer.setInterval(Settings.RESCAN_DELAY)
+        self._media_player = MediaPlayer(
+            self.settings.opened_playlist, self.persistence, self.metadata_index, self.settings.crossfade,
+            self.loudness_index
+        )
+        self._media_player.shuffle = self.settings.shuffle
+        self._media_player.repeat = self.settings.repeat
         self.is_playlist_tab_open = False
+        self._folder_scanner = None
+        self._import_playlist = None
+        self._import_progress = None
+        self._playlist_exporter = None
+
+        self._position = 0
+        self._duration_text = self.format_time(0)
+        self._shown_time_text = None
+        self._shown_slider_pixel = None
+        self._position_timer = QTimer(self)
+        self._position_timer.setSingleShot(True)
+        self._position_timer.setInterval(Settings.POSITION_FRAME_INTERVAL)
+        self._position_timer.timeout.connect(self.render_position)
 
         self.ui.play_button.clicked.connect(self._media_player.play)
         self.ui.pause_button.clicked.connect(self._media_player.pause)
@@ -262,18 +3404,77 @@ class Application(QtWidgets.QMainWindow):
         self.ui.action_new.triggered.connect(self.new_playlist)
         self.ui.action_open.triggered.connect(self.open_playlist)
 
+        self.action_import_playlist = QtWidgets.QAction('Import playlist', self)
+        self.action_import_playlist.triggered.connect(self.import_playlist)
+        self.ui.menuPlaylist.addAction(self.action_import_playlist)
+        self.action_export_playlist = QtWidgets.QAction('Export playlist', self)
+        self.action_export_playlist.triggered.connect(self.export_playlist)
+        self.ui.menuPlaylist.addAction(self.action_export_playlist)
+
         self.ui.action_add_track.triggered.connect(self.add_file)
         self.ui.action_add_folder.triggered.connect(self.add_folder)
+        # There is no playlist to add to until the saved one is restored.
+        self.ui.action_add_track.setEnabled(False)
+        self.ui.action_add_folder.setEnabled(False)
+
+        self.action_watch_folder = QtWidgets.QAction('Watch folder', self)
+        self.action_watch_folder.triggered.connect(self.watch_folder)
+        self.ui.menuPlaylist_2.addAction(self.action_watch_folder)
+
+        self.action_shuffle = QtWidgets.QAction('Shuffle', self)
+        self.action_shuffle.setCheckable(True)
+        self.action_shuffle.setChecked(self.settings.shuffle)
+        self.action_shuffle.toggled.connect(self.set_shuffle)
+        self.ui.menuPlaylist_2.addAction(self.action_shuffle)
+
+        repeat_menu = self.ui.menuPlaylist_2.addMenu('Repeat')
+        repeat_group = QtWidgets.QActionGroup(self)
+        for title, mode in (('Off', PlaybackOrder.REPEAT_OFF), ('All', PlaybackOrder.REPEAT_ALL),
+                            ('One', PlaybackOrder.REPEAT_ONE)):
+            action = QtWidgets.QAction(title, repeat_group)
+            action.setCheckable(True)
+            action.setChecked(mode == self.settings.repeat)
+            action.toggled.connect(partial(self.set_repeat, mode))
+            repeat_menu.addAction(action)
 
         self.ui.playlist_button.clicked.connect(self.playlist_toggle)
+        playlist_view = PlaylistView(self.ui.playlist_frame)
+        playlist_view.setObjectName('playlist')
+        self.ui.horizontalLayout.replaceWidget(self.ui.playlist, playlist_view)
+        self.ui.playlist.deleteLater()
+        self.ui.playlist = playlist_view
         self.ui.playlist.doubleClicked.connect(self.on_playlist_dbl_clicked)
+        self.ui.playlist.rows_dropped.connect(self.move_media)
 
+        self.ui.playlist.setUniformItemSizes(True)
         self.ui.playlist.setModel(self._media_player.get_model())
+        self.filter_model = PlaylistFilterModel(self._media_player.get_model(), self)
+
+        self.search_edit = QtWidgets.QLineEdit(self.ui.playlist_frame)
+        self.search_edit.setPlaceholderText('Search')
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self.search)
+        self._media_player.get_model().tracks_changed.connect(self.refresh_search)
+
+        playlist_layout = QtWidgets.QVBoxLayout()
+        self.ui.horizontalLayout.removeWidget(self.ui.playlist)
+        playlist_layout.addWidget(self.search_edit)
+        playlist_layout.addWidget(self.ui.playlist)
+        self.ui.horizontalLayout.addLayout(playlist_layout)
 
         self.ui.playlist.setContextMenuPolicy(Qt.ActionsContextMenu)
         remove_action = QtWidgets.QAction("Remove", self)
         remove_action.triggered.connect(self.remove_media)
         self.ui.playlist.addAction(remove_action)
+        play_next_action = QtWidgets.QAction("Play next", self)
+        play_next_action.triggered.connect(self.play_next)
+        self.ui.playlist.addAction(play_next_action)
+        move_top_action = QtWidgets.QAction("Move to top", self)
+        move_top_action.triggered.connect(self.move_media_to_top)
+        self.ui.playlist.addAction(move_top_action)
+        move_bottom_action = QtWidgets.QAction("Move to bottom", self)
+        move_bottom_action.triggered.connect(self.move_media_to_bottom)
+        self.ui.playlist.addAction(move_bottom_action)
 
         self._media_player.current_index_changed_connect(self.playlist_position_changed)
 
@@ -281,25 +3482,204 @@ class Application(QtWidgets.QMainWindow):
         self._media_player.position_changed_connect(self.update_position)
         self._media_player.metadata_changed_connect(self.update_metadata)
 
+        self._media_player.set_notify_interval(self.settings.notify_interval)
         self._media_player.connect_volume_slider(self.ui.volume_slider)
+        time_slider = WaveformSlider(self.ui.frame_6)
+        time_slider.setObjectName('time_slider')
+        self.ui.horizontalLayout_6.replaceWidget(self.ui.time_slider, time_slider)
+        self.ui.time_slider.deleteLater()
+        self.ui.time_slider = time_slider
         self._media_player.connect_time_slider(self.ui.time_slider)
+        self.peak_analyzer.analyzed.connect(self.peaks_analyzed)
+        self.peak_analyzer.start()
 
         self._media_player.playlist_events.playlist_changed.connect(self.playlist_changed)
 
-        self._media_player.load()
+        self.metadata_indexer.indexed.connect(self.metadata_indexed)
+        self.metadata_indexer.start()
+        self.loudness_analyzer.analyzed.connect(self.loudness_analyzed)
+        if self.loudness_analyzer.enabled:
+            self.loudness_analyzer.start()
+
+        self.folder_watcher.changes_found.connect(self.folder_changed)
+        self.folder_watcher.directories_found.connect(self.file_watcher.addPaths)
+        self.file_watcher.directoryChanged.connect(self.directory_changed)
+        self._rescan_timer.timeout.connect(self.rescan_directories)
+        self.folder_watcher.start()
+
+        if self.instrumentation is not None:
+            self.instrumentation_dialog = InstrumentationDialog(self.instrumentation, self)
+            self.action_performance = QtWidgets.QAction('Performance', self)
+            self.action_performance.setShortcut('Ctrl+Shift+P')
+            self.action_performance.triggered.connect(self.instrumentation_dialog.show)
+            self.ui.menuPlaylist.addAction(self.action_performance)
+            self.instrumentation.watch_event_loop(self)
+        self.profile.mark('window')
+
+    def restore_playlist(self, report=False):
+        self._report_startup = report
+        self._media_player.playlist_events.playlist_loaded.connect(self.playlist_loaded)
+        self._media_player.playlist_events.playlist_changed.connect(self.playlist_restored)
+        self._media_player.restore()
+
+    def playlist_loaded(self, playlist):
+        self._media_player.playlist_events.playlist_loaded.disconnect(self.playlist_loaded)
+        self.profile.mark('Playlist.load')
+        for folder in self.settings.watched_folders:
+            self.folder_watcher.sync(folder)
+
+    def playlist_restored(self, playlist):
+        self._media_player.playlist_events.playlist_changed.disconnect(self.playlist_restored)
+        self.profile.mark('backend population')
+        if self._report_startup:
+            self.profile.report()
+            self.close()
 
     def add_file(self):
         filenames, ok = QtWidgets.QFileDialog.getOpenFileNames(self, 'Select files', '', 'mp3 Audio (*.mp3);;All files (*.*)')
-        if ok:
-            for file in filenames:
-                self._media_player.add_media(file)
+        if ok and filenames:
+            self.start_import('Add track', files=filenames)
 
     def add_folder(self):
         dialog = QtWidgets.QFileDialog()
         folder = dialog.getExistingDirectory(self, 'Select folder')
-        for dirpath, dirnames, filenames in os.walk(folder):
-            for file in filenames:
-                self._media_player.add_media(os.path.join(dirpath, file))
+        if not folder:
+            return
+        self.start_import('Add folder', folder=folder)
+
+    def watch_folder(self):
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self, 'Select folder to watch')
+        if not folder:
+            return
+        folder = os.path.abspath(folder)
+        self.settings.watch_folder(folder, os.path.abspath(self.settings.opened_playlist))
+        self.folder_watcher.sync(folder)
+
+    def directory_changed(self, directory):
+        self._changed_directories.add(directory)
+        self._rescan_timer.start()
+
+    def rescan_directories(self):
+        self.folder_watcher.rescan(self._changed_directories)
+        self._changed_directories = set()
+
+    def folder_changed(self, folder, added, removed, moved):
+        playlist = self.settings.watched_folders.get(folder)
+        if playlist is None:
+            return
+        added = self._media_player.apply_folder_changes(playlist, added, removed, moved)
+        added += [target for source, target in moved]
+        self.metadata_indexer.enqueue(added)
+        self.loudness_analyzer.enqueue(added)
+
+    def import_playlist(self):
+        path, ok = QtWidgets.QFileDialog.getOpenFileName(
+            self, 'Import playlist', '', 'Playlists (*.m3u *.m3u8 *.pls);;All files (*.*)'
+        )
+        if not ok or not path:
+            return
+        self.cancel_import()
+        self._media_player.create_playlist(self.unused_playlist_name(os.path.splitext(os.path.basename(path))[0]))
+        self.start_import('Import playlist', scanner=PlaylistImporter(path, MediaPlayer.SUPPORTED_FORMATS, self))
+
+    def unused_playlist_name(self, name):
+        candidate = name
+        number = 1
+        while os.path.exists(Playlist.BASE_PATH % candidate):
+            number += 1
+            candidate = '%s (%d)' % (name, number)
+        return candidate
+
+    def export_playlist(self):
+        path, selected = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Export playlist', '', 'M3U (*.m3u);;M3U8 (*.m3u8);;PLS (*.pls)'
+        )
+        if not path:
+            return
+        if os.path.splitext(path)[1].lower() not in PlaylistExporter.FORMATS:
+            path += selected[selected.find('*') + 1:-1] or '.m3u8'
+        self.wait_export()
+        self._playlist_exporter = PlaylistExporter(self._media_player.track_list(), path, self)
+        self._playlist_exporter.finished.connect(self.export_finished)
+        self._playlist_exporter.start()
+
+    def export_finished(self):
+        if self._playlist_exporter is not None:
+            self._playlist_exporter.deleteLater()
+            self._playlist_exporter = None
+
+    def wait_export(self):
+        if self._playlist_exporter is not None:
+            self._playlist_exporter.wait()
+            self.export_finished()
+
+    def start_import(self, title, folder=None, files=None, scanner=None):
+        self.cancel_import()
+
+        self._import_progress = QtWidgets.QProgressDialog('Scanning...', 'Cancel', 0, 0, self)
+        self._import_progress.setWindowTitle(title)
+        self._import_progress.setMinimumDuration(500)
+        self._import_playlist = self._media_player.current_playlist()
+
+        self._folder_scanner = scanner or FolderScanner(
+            folder, MediaPlayer.SUPPORTED_FORMATS, self._media_player.track_list(), files, self
+        )
+        self._folder_scanner.chunk_found.connect(self.import_chunk)
+        self._folder_scanner.progress.connect(self.import_progress)
+        self._folder_scanner.finished.connect(self.import_finished)
+        self._import_progress.canceled.connect(self._folder_scanner.cancel)
+        self._folder_scanner.start()
+
+    def import_chunk(self, files):
+        if self._folder_scanner is None or self._folder_scanner.is_cancelled():
+            return
+        self._media_player.add_media_batch(files)
+        self.metadata_indexer.enqueue(files)
+        self.loudness_analyzer.enqueue(files)
+
+    def import_progress(self, added, duplicates):
+        if self._import_progress is not None:
+            self._import_progress.setLabelText(self._folder_scanner.PROGRESS_TEXT % (added, duplicates))
+
+    def import_finished(self):
+        if self._import_progress is not None:
+            self._import_progress.reset()
+            self._import_progress.deleteLater()
+            self._import_progress = None
+        if self._folder_scanner is not None:
+            self._folder_scanner.deleteLater()
+            self._folder_scanner = None
+
+    def cancel_import(self):
+        if self._folder_scanner is not None:
+            self._folder_scanner.finished.disconnect(self.import_finished)
+            self._folder_scanner.cancel()
+            self._folder_scanner.wait()
+        self.import_finished()
+
+    def closeEvent(self, event):
+        self.cancel_import()
+        self.wait_export()
+        self.folder_watcher.stop()
+        self.metadata_indexer.stop()
+        self.loudness_analyzer.stop()
+        self.peak_analyzer.stop()
+        self.metadata_index.close()
+        self.loudness_index.close()
+        self.persistence.close()
+        super(Application, self).closeEvent(event)
+
+    def metadata_indexed(self, records):
+        self.metadata_index.update(records)
+        paths = [record['path'] for record in records]
+        self._media_player.get_model().metadata_changed(paths)
+        if self._media_player.current_track() in paths:
+            self.update_track_info()
+
+    def loudness_analyzed(self, records):
+        self.loudness_index.update(records)
+        if self._media_player.current_track() in [record['path'] for record in records]:
+            self._media_player.refresh_gain()
 
     def new_playlist(self):
         playlist_name, ok = QtWidgets.QInputDialog().getText(self, 'Playlist name', 'Enter new playlist name')
@@ -314,6 +3694,13 @@ class Application(QtWidgets.QMainWindow):
     def playlist_changed(self, playlist):
         self.settings.set_opened_playlist(playlist.path)
         self.ui.playlist_name_label.setText(playlist.name)
+        self.ui.action_add_track.setEnabled(True)
+        self.ui.action_add_folder.setEnabled(True)
+        # The rest of a running import belongs to the playlist it was started for.
+        if self._folder_scanner is not None and playlist is not self._import_playlist:
+            self.cancel_import()
+        self.metadata_indexer.enqueue(playlist.tracks)
+        self.loudness_analyzer.enqueue(playlist.tracks)
 
     def playlist_toggle(self):
         if not self.is_playlist_tab_open:
@@ -333,29 +3720,114 @@ class Application(QtWidgets.QMainWindow):
 
         self.is_playlist_tab_open = not self.is_playlist_tab_open
 
+    def selected_row(self):
+        row = self.ui.playlist.currentIndex().row()
+        if row >= 0 and self.ui.playlist.model() is self.filter_model:
+            return self.filter_model.source_row(row)
+        return row
+
+    def selected_rows(self):
+        rows = self.ui.playlist.selected_rows()
+        if self.ui.playlist.model() is self.filter_model:
+            rows = [self.filter_model.source_row(row) for row in rows]
+        if not rows and self.selected_row() >= 0:
+            rows = [self.selected_row()]
+        return sorted(rows)
+
     def remove_media(self):
-        index = self.ui.playlist.currentIndex().row()
-        self._media_player.remove_media(index)
+        self._media_player.remove_rows(self.selected_rows())
+
+    def move_media(self, rows, target):
+        if self.ui.playlist.model() is self.filter_model:
+            return
+        self._media_player.move_rows(rows, target)
+
+    def move_media_to_top(self):
+        self._media_player.move_rows(self.selected_rows(), 0)
+
+    def move_media_to_bottom(self):
+        self._media_player.move_rows(self.selected_rows(), len(self._media_player.track_list()))
+
+    def play_next(self):
+        self._media_player.enqueue(self.selected_rows())
+
+    def set_shuffle(self, shuffle):
+        self._media_player.set_shuffle(shuffle)
+        self.settings.shuffle = shuffle
+        self.settings.save()
+
+    def set_repeat(self, repeat, checked):
+        if not checked:
+            return
+        self._media_player.set_repeat(repeat)
+        self.settings.repeat = repeat
+        self.settings.save()
 
     def on_playlist_dbl_clicked(self):
-        index = self.ui.playlist.currentIndex().row()
+        index = self.selected_row()
         self._media_player.set_current_index(index)
         self._media_player.play()
 
+    def search(self, query):
+        rows = self._media_player.get_model().search(query)
+        if rows is None:
+            self.ui.playlist.setModel(self._media_player.get_model())
+        else:
+            self.filter_model.set_rows(rows)
+            if self.ui.playlist.model() is not self.filter_model:
+                self.ui.playlist.setModel(self.filter_model)
+
+    def refresh_search(self):
+        if self.search_edit.text():
+            self.search(self.search_edit.text())
+
     def update_duration(self, duration):
         self.ui.time_slider.setMaximum(duration)
 
         if duration >= 0:
-            self.ui.current_time_label.setText('00:00/%s' % self.format_time(duration))
+            self._duration_text = self.format_time(duration)
+        self._shown_time_text = None
+        self._shown_slider_pixel = None
+        self.render_position()
 
     def update_position(self, position):
-        if position >= 0:
-            max_time = self.ui.current_time_label.text()[6:]
-            self.ui.current_time_label.setText('%s/%s' % (self.format_time(position), max_time))
+        self._position = position
+        if not self._position_timer.isActive():
+            self._position_timer.start()
 
-        self.ui.time_slider.blockSignals(True)
-        self.ui.time_slider.setValue(position)
-        self.ui.time_slider.blockSignals(False)
+    def render_position(self):
+        if self.isMinimized() or not self.isVisible():
+            return
+
+        position = self._position
+        if position >= 0:
+            text = '%s/%s' % (self.format_time(position), self._duration_text)
+            if text != self._shown_time_text:
+                self.ui.current_time_label.setText(text)
+                self._shown_time_text = text
+
+        slider = self.ui.time_slider
+        if slider.isSliderDown():
+            return
+        pixel = QtWidgets.QStyle.sliderPositionFromValue(slider.minimum(), slider.maximum(), position, slider.width())
+        if pixel != self._shown_slider_pixel:
+            slider.blockSignals(True)
+            slider.setValue(position)
+            slider.blockSignals(False)
+            self._shown_slider_pixel = pixel
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.WindowStateChange and not self.isMinimized():
+            self.render_position()
+        super(Application, self).changeEvent(event)
+
+    def showEvent(self, event):
+        super(Application, self).showEvent(event)
+        self.render_position()
+
+    def resizeEvent(self, event):
+        super(Application, self).resizeEvent(event)
+        self._shown_slider_pixel = None
 
     def format_time(self, ms):
         s = round(ms / 1000)
@@ -364,34 +3836,129 @@ class Application(QtWidgets.QMainWindow):
         return "%02d:%02d" % (m, s)
 
     def update_metadata(self):
-        if self._media_player.isMetaDataAvailable():
+        self.update_cover()
+        self.update_track_info()
+
+    def update_cover(self):
+        track = self._media_player.current_track()
+        if track is None:
+            self.ui.cover_label.setPixmap(self.cover_cache.placeholder())
+            return
+
+        record = self.metadata_index.get(track)
+        if record is not None and record['album']:
+            key = CoverCache.key(track, record['album_artist'] or record['artist'], record['album'])
+        elif self._media_player.isMetaDataAvailable():
+            key = CoverCache.key(
+                track,
+                self._media_player.metaData(QMediaMetaData.AlbumArtist),
+                self._media_player.metaData(QMediaMetaData.AlbumTitle)
+            )
+        else:
+            key = CoverCache.key(track)
+
+        pixmap = self.cover_cache.get(key)
+        if pixmap is None and self._media_player.isMetaDataAvailable():
+            image = self._media_player.metaData(QMediaMetaData.ThumbnailImage)
+            if isinstance(image, QImage) and not image.isNull():
+                pixmap = self.cover_cache.put(key, image)
+        self.ui.cover_label.setPixmap(pixmap or self.cover_cache.placeholder())
+
+    def update_track_info(self):
+        record = None
+        track = self._media_player.current_track()
+        if track is not None:
+            record = self.metadata_index.get(track)
+
+        if record is not None and record['title']:
+            album_title, title, album_artist = record['album'], record['title'], record['album_artist'] or record['artist']
+        elif self._media_player.isMetaDataAvailable():
             album_title = self._media_player.metaData(QMediaMetaData.AlbumTitle)
             title = self._media_player.metaData(QMediaMetaData.Title)
             album_artist = self._media_player.metaData(QMediaMetaData.AlbumArtist)
-            image = self._media_player.metaData(QMediaMetaData.ThumbnailImage)
-
-            try:
-                self.ui.cover_label.setPixmap(QPixmap.fromImage(image).scaled(278, 268, Qt.KeepAspectRatio))
-                self.ui.title_label.setText(f'{album_title} - {title}')
-                self.ui.artist_label.setText(f'{album_artist}')
-            except TypeError:
-                pass
         else:
-            qb = QPixmap()
-            qb.load('no-photo.png')
-            self.ui.cover_label.setPixmap(qb.scaled(278, 268, Qt.KeepAspectRatio))
             self.ui.title_label.setText('No data')
             self.ui.artist_label.setText('No data')
+            return
+
+        self.ui.title_label.setText(f'{album_title} - {title}' if album_title else f'{title}')
+        self.ui.artist_label.setText(f'{album_artist}')
 
     def playlist_position_changed(self, i: int):
-        if i > -1:
-            ix = self._media_player.get_model().index(i)
-            self.ui.playlist.setCurrentIndex(ix)
+        if i > -1 and self.ui.playlist.model() is self.filter_model:
+            row = self.filter_model.filter_row(i)
+            if row > -1:
+                self.show_current(self.filter_model.index(row))
+        elif i > -1:
+            model = self._media_player.get_model()
+            model.ensure_fetched(i)
+            ix = model.index(i)
+            self.show_current(ix)
+        self.update_cover()
+        self.update_track_info()
+        self.update_waveform()
+
+    def show_current(self, index):
+        # A multi-row selection is being worked on, so only the current row follows playback.
+        selection = self.ui.playlist.selectionModel()
+        if sum(selection_range.height() for selection_range in selection.selection()) > 1:
+            selection.setCurrentIndex(index, QItemSelectionModel.NoUpdate)
+        else:
+            self.ui.playlist.setCurrentIndex(index)
+
+    def update_waveform(self):
+        track = self._media_player.current_track()
+        peaks = None
+        if track is not None:
+            peaks = self.peak_cache.get(PeakCache.key(track))
+            if peaks is None:
+                self.peak_analyzer.analyze(track)
+        self.ui.time_slider.set_peaks(peaks)
+
+    def peaks_analyzed(self, track, key):
+        if track == self._media_player.current_track():
+            self.ui.time_slider.set_peaks(self.peak_cache.get(key))
+
+
+def instrument(instrumentation):
+    instrumentation.patch(Application, [
+        'update_metadata', 'update_cover', 'update_track_info', 'update_duration', 'update_position',
+        'render_position', 'update_waveform', 'playlist_position_changed', 'playlist_changed', 'playlist_loaded',
+        'metadata_indexed', 'loudness_analyzed', 'import_chunk', 'import_progress', 'folder_changed',
+        'rescan_directories', 'search', 'refresh_search', 'on_playlist_dbl_clicked', 'remove_media', 'move_media',
+    ])
+    instrumentation.patch(MediaPlayer, [
+        'play', 'pause', 'stop', 'next', 'prev', 'set_volume', 'set_position', 'load_track', 'preload',
+        'media_status_changed', 'player_position_changed', 'fade_step', 'refresh_gain', 'add_media_batch',
+        'remove_media', 'remove_rows', 'move_rows', 'set_shuffle', 'enqueue',
+    ])
+    instrumentation.patch(PlaybackOrder, ['set_shuffle', 'inserted', 'removed', 'moved', 'flush'])
+    instrumentation.patch(Playlist, ['save', 'flush', 'load'])
+    instrumentation.patch(Settings, ['save', 'flush'])
+    instrumentation.patch(PersistenceService, ['mark_dirty'])
 
 
 if __name__ == '__main__':
-    app = QtWidgets.QApplication([])
-    application = Application()
+    profile = StartupProfile(STARTUP_TIME)
+    profile.mark('imports')
+    if '--headless' in sys.argv:
+        app = QCoreApplication(sys.argv)
+        profile.mark('QCoreApplication')
+        player = HeadlessPlayer(profile)
+        if not player.start(report='--profile-startup' in sys.argv):
+            sys.exit(1)
+        sys.exit(app.exec())
+
+    instrumentation = None
+    if '--instrument' in sys.argv:
+        instrumentation = Instrumentation()
+        instrument(instrumentation)
+    app = QtWidgets.QApplication(sys.argv)
+    profile.mark('QApplication')
+    application = Application(profile, instrumentation)
     application.show()
+    app.processEvents()
+    profile.mark('first paint')
+    application.restore_playlist(report='--profile-startup' in sys.argv)
 
     sys.exit(app.exec())
@@ -0,0 +1,136 @@
+import os
+import hashlib
+
+
+def partial_hash(path, block_size=64 * 1024):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            digest.update(f.read(block_size))
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(block_size, size - block_size))
+            digest.update(f.read(block_size))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def full_hash(path, block_size=1024 * 1024):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def read_tags(path):
+    record = {'title': None, 'artist': None, 'album': None, 'album_artist': None, 'duration': None}
+    if os.path.splitext(path)[1].lower() != '.mp3':
+        return record
+    try:
+        import eyed3
+    except ImportError:
+        return record
+    eyed3.log.setLevel('ERROR')
+    try:
+        audio = eyed3.load(path)
+    except Exception:
+        return record
+    if audio is None:
+        return record
+    if audio.info is not None:
+        record['duration'] = int(audio.info.time_secs * 1000)
+    if audio.tag is not None:
+        record['title'] = audio.tag.title
+        record['artist'] = audio.tag.artist
+        record['album'] = audio.tag.album
+        record['album_artist'] = audio.tag.album_artist
+    return record
+
+
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class LoudnessMeter:
+    SAMPLE_RATE = 22050
+    BLOCK = 0.1
+    ABSOLUTE_GATE = -70
+    RELATIVE_GATE = -10
+
+    def __init__(self, numpy):
+        self.numpy = numpy
+        self.window = None
+        self.channels = 1
+        self.peak = 0.0
+        self.rest = numpy.empty(0, dtype=numpy.float32)
+        self.powers = []
+
+    @staticmethod
+    def loudness(numpy, power):
+        return -0.691 + 10 * numpy.log10(numpy.maximum(power, 1e-12))
+
+    def feed(self, samples, audio_format):
+        numpy = self.numpy
+        if self.window is None:
+            self.channels = max(1, audio_format.channelCount())
+            self.window = max(1, int(audio_format.sampleRate() * self.BLOCK)) * self.channels
+        if len(samples):
+            self.peak = max(self.peak, float(numpy.abs(samples).max()))
+        if len(self.rest):
+            samples = numpy.concatenate((self.rest, samples))
+        count = len(samples) // self.window * self.window
+        if count:
+            frames = samples[:count].reshape(-1, self.window // self.channels, self.channels)
+            self.powers.append(numpy.square(frames).mean(axis=1).sum(axis=1))
+        self.rest = samples[count:]
+
+    def result(self):
+        numpy = self.numpy
+        if not self.powers:
+            return None
+        powers = numpy.concatenate(self.powers)
+        if len(powers) < 4:
+            return None
+        # 400 ms gating blocks with 75% overlap, built from 100 ms sub-blocks.
+        blocks = (powers[:-3] + powers[1:-2] + powers[2:-1] + powers[3:]) / 4
+        blocks = blocks[self.loudness(numpy, blocks) > self.ABSOLUTE_GATE]
+        if not len(blocks):
+            return None
+        threshold = self.loudness(numpy, blocks.mean()) + self.RELATIVE_GATE
+        blocks = blocks[self.loudness(numpy, blocks) > threshold]
+        power = float(blocks.mean())
+        return {
+            'loudness': float(self.loudness(numpy, power)),
+            'peak': self.peak,
+            'power': power,
+            'blocks': len(blocks),
+        }
+
+
+_decoder_application = None
+
+
+def measure_loudness(path):
+    global _decoder_application
+    record = {'loudness': None, 'peak': None, 'power': None, 'blocks': None}
+    numpy = load_numpy()
+    if numpy is None:
+        return record
+    # Qt is only loaded by workers that decode, tag and hash workers never need it.
+    from PyQt5.QtCore import QCoreApplication
+    from decoder import PcmDecoder
+    # QAudioDecoder needs an application object in the worker process.
+    if QCoreApplication.instance() is None:
+        _decoder_application = QCoreApplication([])
+    meter = LoudnessMeter(numpy)
+    if PcmDecoder(numpy, 2, LoudnessMeter.SAMPLE_RATE).decode(path, meter.feed):
+        record.update(meter.result() or {})
+    return record